@@ -39,6 +39,340 @@ __docformat__ = "restructuredtext en"
 import pelix.constants
 import pelix.remote
 import pelix.ldapfilter
+from pelix.utilities import is_string
+
+# Standard library
+import logging
+import re
+
+try:
+    # Python 3.3+
+    from types import MappingProxyType
+
+except ImportError:
+    # Python 2
+    class MappingProxyType(dict):
+        """
+        Read-only copy of a dictionary
+        """
+        def __read_only(self, *args, **kwargs):
+            """
+            Refuses modifications
+            """
+            raise TypeError("Read-only dictionary")
+
+        __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+            update = __read_only
+
+# ------------------------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+
+FILTERS_CACHE_SIZE = 512
+""" Maximum number of compiled filters kept in cache """
+
+_FILTERS = {}
+""" LDAP filter string -> compiled filter """
+
+VERSIONS_CACHE_SIZE = 512
+""" Maximum number of parsed versions and version ranges kept in cache """
+
+_VERSIONS = {}
+""" Version string -> Version """
+
+_RANGES = {}
+""" Version range string -> VersionRange """
+
+_VERSION_PATTERN = re.compile(r"^(\d+)(?:\.(\d+)(?:\.(\d+))?)?(?:[.-](.*))?$")
+""" Version string: major[.minor[.micro]][.qualifier] (or -qualifier) """
+
+# ------------------------------------------------------------------------------
+
+def _to_tuple(value):
+    """
+    Converts a property value to a tuple
+
+    :param value: A string or a collection of strings
+    :return: A tuple
+    """
+    if value is None:
+        return ()
+
+    elif is_string(value):
+        return (value,)
+
+    return tuple(value)
+
+
+def get_filter(ldap_filter):
+    """
+    Returns the compiled form of the given LDAP filter. Filter strings are
+    parsed only once.
+
+    :param ldap_filter: An LDAP filter string or object
+    :return: The compiled filter, or None
+    :raise ValueError: Invalid filter string
+    """
+    if not is_string(ldap_filter):
+        # Already compiled (or None)
+        return pelix.ldapfilter.get_ldap_filter(ldap_filter)
+
+    try:
+        return _FILTERS[ldap_filter]
+
+    except KeyError:
+        compiled = pelix.ldapfilter.get_ldap_filter(ldap_filter)
+        if len(_FILTERS) >= FILTERS_CACHE_SIZE:
+            # Don't let the cache grow forever
+            _FILTERS.clear()
+
+        _FILTERS[ldap_filter] = compiled
+        return compiled
+
+# ------------------------------------------------------------------------------
+
+class Version(tuple):
+    """
+    A package version: (major, minor, micro, qualifier).
+
+    Versions are tuples, compared and hashed as such: numbers are compared
+    numerically, then qualifiers as strings.
+    """
+    __slots__ = ()
+
+    def __new__(cls, major=0, minor=0, micro=0, qualifier=""):
+        """
+        Sets up the version
+
+        :param major: Major version number
+        :param minor: Minor version number
+        :param micro: Micro version number
+        :param qualifier: Version qualifier
+        """
+        return tuple.__new__(cls, (major, minor, micro, qualifier))
+
+
+    def __getnewargs__(self):
+        """
+        Pickling support
+        """
+        return tuple(self)
+
+
+    def __repr__(self):
+        """
+        String representation
+        """
+        return "Version{0}".format(tuple.__repr__(self))
+
+
+    def __str__(self):
+        """
+        Version string
+        """
+        if self[3]:
+            return "{0}.{1}.{2}.{3}".format(*self)
+
+        return "{0}.{1}.{2}".format(*self)
+
+
+    @property
+    def major(self):
+        """
+        Major version number
+        """
+        return self[0]
+
+
+    @property
+    def minor(self):
+        """
+        Minor version number
+        """
+        return self[1]
+
+
+    @property
+    def micro(self):
+        """
+        Micro version number
+        """
+        return self[2]
+
+
+    @property
+    def qualifier(self):
+        """
+        Version qualifier
+        """
+        return self[3]
+
+
+_NO_VERSION = Version()
+""" Version of the packages without version information """
+
+
+class VersionRange(object):
+    """
+    A range of versions, from a floor to an optional ceiling
+    """
+    __slots__ = ('floor', 'floor_included', 'ceiling', 'ceiling_included')
+
+    def __init__(self, floor, floor_included=True, ceiling=None,
+                 ceiling_included=False):
+        """
+        Sets up the range
+
+        :param floor: Lowest version of the range
+        :param floor_included: If True, the floor is in the range
+        :param ceiling: Highest version of the range, None for no limit
+        :param ceiling_included: If True, the ceiling is in the range
+        """
+        self.floor = floor
+        self.floor_included = floor_included
+        self.ceiling = ceiling
+        self.ceiling_included = ceiling_included
+
+
+    def __contains__(self, version):
+        """
+        Tests if the given version is in the range
+        """
+        return self.includes(version)
+
+
+    def __str__(self):
+        """
+        Range string
+        """
+        if self.ceiling is None:
+            return str(self.floor)
+
+        return "{0}{1},{2}{3}".format("[" if self.floor_included else "(",
+                                      self.floor, self.ceiling,
+                                      "]" if self.ceiling_included else ")")
+
+
+    def includes(self, version):
+        """
+        Tests if the given version is in the range
+
+        :param version: A Version
+        :return: True if the version is in the range
+        """
+        floor = self.floor
+        if version < floor or (not self.floor_included and version == floor):
+            return False
+
+        ceiling = self.ceiling
+        return ceiling is None or version < ceiling \
+            or (self.ceiling_included and version == ceiling)
+
+
+def _cache_version(cache, value, parsed):
+    """
+    Stores a parsed version or range in the given cache
+
+    :param cache: The versions or ranges cache
+    :param value: The parsed string
+    :param parsed: The Version or VersionRange
+    :return: The parsed object
+    """
+    if len(cache) >= VERSIONS_CACHE_SIZE:
+        # Don't let the cache grow forever
+        cache.clear()
+
+    cache[value] = parsed
+    return parsed
+
+
+def parse_version(value):
+    """
+    Parses a version string ("major.minor.micro.qualifier", missing numbers
+    being 0). Version strings are parsed only once.
+
+    Invalid versions are accepted as the 0.0.0 version, with the whole string
+    as qualifier.
+
+    :param value: A version string, a number, a tuple or None
+    :return: A Version
+    """
+    if isinstance(value, Version):
+        return value
+
+    elif not value:
+        return Version()
+
+    elif isinstance(value, (tuple, list)):
+        # Version parts
+        value = ".".join(str(part) for part in value)
+
+    elif not is_string(value):
+        # Number
+        value = str(value)
+
+    try:
+        return _VERSIONS[value]
+
+    except KeyError:
+        pass
+
+    stripped = value.strip()
+    match = _VERSION_PATTERN.match(stripped)
+    if match is None:
+        _logger.warning("Invalid version: %r", value)
+        version = Version(qualifier=stripped)
+
+    else:
+        major, minor, micro, qualifier = match.groups()
+        version = Version(int(major), int(minor or 0), int(micro or 0),
+                          qualifier or "")
+
+    return _cache_version(_VERSIONS, value, version)
+
+
+def parse_range(value):
+    """
+    Parses a version range string: "[floor,ceiling)", with brackets to
+    include a bound and parenthesis to exclude it, or a single version to
+    accept all versions from it. Range strings are parsed only once.
+
+    :param value: A range string, or a VersionRange
+    :return: A VersionRange
+    :raise ValueError: Invalid range
+    """
+    if isinstance(value, VersionRange):
+        return value
+
+    elif not is_string(value):
+        # Single version, given as a number or a tuple
+        return VersionRange(parse_version(value))
+
+    try:
+        return _RANGES[value]
+
+    except KeyError:
+        pass
+
+    stripped = value.strip()
+    if stripped[:1] not in ("[", "("):
+        # Single version: no ceiling
+        return _cache_version(_RANGES, value,
+                              VersionRange(parse_version(stripped)))
+
+    if stripped[-1:] not in ("]", ")") or stripped.count(",") != 1:
+        raise ValueError("Invalid version range: {0}".format(value))
+
+    floor, ceiling = stripped[1:-1].split(",")
+    if not floor.strip() or not ceiling.strip():
+        raise ValueError("Missing bound in version range: {0}".format(value))
+
+    return _cache_version(_RANGES, value,
+                          VersionRange(parse_version(floor), stripped[0] == "[",
+                                       parse_version(ceiling),
+                                       stripped[-1] == "]"))
 
 # ------------------------------------------------------------------------------
 
@@ -47,8 +381,14 @@ class EndpointDescription(object):
     Endpoint description bean, according to OSGi specifications:
     http://www.osgi.org/javadoc/r4v42/org/osgi/service/remoteserviceadmin/EndpointDescription.html
 
-    This is an importer-side description
+    This is an importer-side description.
+
+    The description is immutable: the getters return shared read-only views
+    and tuples, which must not be modified.
     """
+    __slots__ = ('__properties', '__view', '__configurations', '__intents',
+                 '__interfaces', '__versions')
+
     def __init__(self, svc_ref, properties):
         """
         Sets up the description with the given properties
@@ -71,10 +411,32 @@ class EndpointDescription(object):
 
             # TODO: Framework UUID ??
 
-        self.__check_properties(properties)
+        self.__check_properties(all_properties)
+
+        # Keep our own copy of properties, and a read-only view on it
+        self.__properties = all_properties
+        self.__view = MappingProxyType(all_properties)
 
-        # Keep a copy of properties
-        self.__properties = properties.copy()
+        # Frozen lists
+        self.__configurations = _to_tuple(
+                            all_properties[pelix.remote.PROP_IMPORTED_CONFIGS])
+        self.__interfaces = _to_tuple(
+                                    all_properties[pelix.constants.OBJECTCLASS])
+        self.__intents = _to_tuple(
+                            all_properties.get(pelix.remote.PROP_INTENTS))
+
+        # Package -> Version
+        prefix = pelix.remote.PROP_ENDPOINT_PACKAGE_VERSION_
+        self.__versions = dict((key[len(prefix):], parse_version(value))
+                               for key, value in all_properties.items()
+                               if key.startswith(prefix))
+
+
+    def __reduce__(self):
+        """
+        Pickling support: the description is rebuilt from its properties
+        """
+        return EndpointDescription, (None, self.__properties)
 
 
     def __str__(self):
@@ -127,10 +489,9 @@ class EndpointDescription(object):
         This value of the configuration types is stored in the
         pelix.remote.PROP_IMPORTED_CONFIGS service property.
 
-        :return: The configuration types (list of str)
+        :return: The configuration types (tuple of str)
         """
-        # Return a copy of the list
-        return self.__properties[pelix.remote.PROP_IMPORTED_CONFIGS][:]
+        return self.__configurations
 
 
     def get_framework_uuid(self):
@@ -160,22 +521,18 @@ class EndpointDescription(object):
         This value of the intents is stored in the
         pelix.remote.PROP_INTENTS service property.
 
-        :return: A list of intents (list of str)
+        :return: A tuple of intents (tuple of str)
         """
-        # Return a copy of the list
-        try:
-            return self.__properties[pelix.remote.PROP_INTENTS][:]
-        except KeyError:
-            return []
+        return self.__intents
 
 
     def get_interfaces(self):
         """
         Provides the list of interfaces implemented by the exported service.
 
-        :return: A list of specifications (list of str)
+        :return: A tuple of specifications (tuple of str)
         """
-        return self.__properties[pelix.constants.OBJECTCLASS][:]
+        return self.__interfaces
 
 
     def get_package_version(self, package):
@@ -183,29 +540,19 @@ class EndpointDescription(object):
         Provides the version of the given package name.
 
         :param package: The name of the package
-        :return: The version of the specified package as a tuple or (0,0,0)
+        :return: The version of the specified package as a Version, which is
+                 0.0.0 if the package version isn't given
         """
-        name = "{0}{1}".format(pelix.remote.PROP_ENDPOINT_PACKAGE_VERSION_,
-                               package)
-        try:
-            # Get the version string
-            version = self.__properties[name]
-
-            # Split dots ('.')
-            return tuple(version.split('.'))
-
-        except KeyError:
-            # No version
-            return (0, 0, 0)
+        return self.__versions.get(package, _NO_VERSION)
 
 
     def get_properties(self):
         """
         Returns all endpoint properties.
 
-        :return: A copy of the endpoint properties
+        :return: A read-only view on the endpoint properties
         """
-        return self.__properties.copy()
+        return self.__view
 
 
     def get_service_id(self):
@@ -241,5 +588,80 @@ class EndpointDescription(object):
         :param ldap_filter: A filter
         :return: True if properties matches the filter
         """
-        return pelix.ldapfilter.get_ldap_filter(ldap_filter)\
-                                                    .matches(self.__properties)
+        return get_filter(ldap_filter).matches(self.__properties)
+
+
+    def matches_versions(self, ranges):
+        """
+        Tests if the versions of the packages of this endpoint are in the
+        given ranges
+
+        :param ranges: A package -> VersionRange (or range string) dictionary
+        :return: True if all package versions are in their range
+        :raise ValueError: Invalid range string
+        """
+        for package, version_range in ranges.items():
+            if not parse_range(version_range).includes(
+                                        self.__versions.get(package,
+                                                            _NO_VERSION)):
+                return False
+
+        return True
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    # Compares the parsing of filters at each test with the filters cache
+    import timeit
+
+    nb_endpoints = 5000
+    endpoints = []
+    for idx in range(nb_endpoints):
+        endpoints.append(EndpointDescription(None, {
+                    pelix.remote.PROP_ENDPOINT_ID: "endpoint-{0}".format(idx),
+                    pelix.remote.PROP_ENDPOINT_FRAMEWORK_UUID:
+                                        "framework-{0}".format(idx % 50),
+                    pelix.remote.PROP_IMPORTED_CONFIGS:
+                                        ["ecf.jabsorb", "jsonrpc"][idx % 2:],
+                    pelix.constants.OBJECTCLASS:
+                                        ["sample.spec.{0}".format(idx % 100)],
+                    pelix.remote.PROP_ENDPOINT_PACKAGE_VERSION_ + "sample":
+                                        "1.{0}.0".format(idx % 10)}))
+
+    filters = ["(&(objectClass=sample.spec.{0})(service.imported.configs="
+               "jsonrpc))".format(idx) for idx in range(10)]
+
+    def parsed():
+        """
+        Parses the filter for each endpoint
+        """
+        return [[endpoint for endpoint in endpoints
+                 if pelix.ldapfilter.get_ldap_filter(ldap_filter)
+                 .matches(endpoint.get_properties())]
+                for ldap_filter in filters]
+
+    def cached():
+        """
+        Uses the compiled filters cache
+        """
+        return [[endpoint for endpoint in endpoints
+                 if endpoint.matches(ldap_filter)]
+                for ldap_filter in filters]
+
+    assert parsed() == cached()
+
+    for name, method in (("parsed", parsed), ("cached", cached)):
+        duration = min(timeit.repeat(method, number=1, repeat=3))
+        print("{0:<8}: {1} filters on {2} endpoints in {3:.3f}s"
+              .format(name, len(filters), nb_endpoints, duration))
+
+    # Package version ranges
+    ranges = {"sample": "[1.2,1.5)"}
+    assert len([endpoint for endpoint in endpoints
+                if endpoint.matches_versions(ranges)]) == nb_endpoints * 3 // 10
+
+    duration = min(timeit.repeat(
+                    lambda: [endpoint.matches_versions(ranges)
+                             for endpoint in endpoints], number=1, repeat=3))
+    print("versions: 1 range on {0} endpoints in {1:.3f}s"
+          .format(nb_endpoints, duration))
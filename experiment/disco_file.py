@@ -36,9 +36,12 @@ __docformat__ = "restructuredtext en"
 # ------------------------------------------------------------------------------
 
 # Local
+from experiment.interning import intern_properties
+import experiment.beans as edef_beans
 import experiment.edef as edef
 
 # Remote services
+import pelix.constants
 import pelix.remote
 import pelix.remote.beans as beans
 import pelix.services
@@ -48,22 +51,173 @@ from pelix.ipopo.decorators import ComponentFactory, Requires, Provides, \
     Invalidate, Validate, Property
 
 # Standard library
+import hashlib
+import io
 import logging
+import multiprocessing
 import os
 
+try:
+    # Python 2: C version
+    import cPickle as pickle
+except ImportError:
+    # Python 3
+    import pickle
+
+try:
+    # C version
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    # Fall back
+    import xml.etree.ElementTree as ElementTree
+
 # ------------------------------------------------------------------------------
 
 _logger = logging.getLogger(__name__)
 
+PARALLEL_MIN_FILES = 16
+"""
+Minimum number of files found by the initial scan of the folder to parse them
+in a process pool
+"""
+
+CACHE_FORMAT = 1
+""" Version of the format of the parsed files cache """
+
+# ------------------------------------------------------------------------------
+
+def _parse_file(args):
+    """
+    Reads and parses an EDEF file. Called by the processes of the parsing pool.
+
+    :param args: A (path, known content hash or None) tuple
+    :return: None if the file can't be read, else a (size, mtime, digest,
+             properties, error) tuple. properties is None if the content hash
+             is the known one, else the list of the properties of the
+             endpoints read before the end of the file or the parsing error.
+    """
+    path, known_digest = args
+    try:
+        stat = os.stat(path)
+        with open(path, 'rb') as filep:
+            content = filep.read()
+
+    except (IOError, OSError):
+        return None
+
+    digest = hashlib.sha1(content).digest()
+    if digest == known_digest:
+        # Same content
+        return stat.st_size, stat.st_mtime, digest, None, None
+
+    properties = []
+    try:
+        for endpoint in edef.EDEFReader().iterparse(io.BytesIO(content)):
+            properties.append(dict(endpoint.get_properties()))
+
+    except ValueError as ex:
+        return stat.st_size, stat.st_mtime, digest, properties, str(ex)
+
+    return stat.st_size, stat.st_mtime, digest, properties, None
+
+
+def _freeze(value):
+    """
+    Converts a property value into a hashable, comparable form
+
+    :param value: A property value
+    :return: A hashable value
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(item) for item in value)
+
+    elif isinstance(value, dict):
+        return frozenset((key, _freeze(item)) for key, item in value.items())
+
+    elif ElementTree.iselement(value):
+        # XML value: compare its content
+        return ElementTree.tostring(value)
+
+    return value
+
+
+def _signature(properties):
+    """
+    Computes the signature of endpoint properties: two endpoints with the
+    same properties have equal signatures
+
+    :param properties: Endpoint properties
+    :return: A hashable signature
+    """
+    return _freeze(properties)
+
+
+class _EdefFile(object):
+    """
+    State of a loaded EDEF file
+    """
+    __slots__ = ('size', 'mtime', 'digest', 'properties', 'endpoints')
+
+    def __init__(self):
+        """
+        Sets up members
+        """
+        # File size and modification time, None to force a reading
+        self.size = None
+        self.mtime = None
+
+        # Hash of the file content
+        self.digest = None
+
+        # Properties of the endpoints of the file, as read (for the cache)
+        self.properties = None
+
+        # Endpoint UID -> (properties signature, ImportEndpoint)
+        self.endpoints = {}
+
+    def is_same_stat(self, stat):
+        """
+        Checks if the file size and modification time are the known ones
+
+        :param stat: Result of os.stat()
+        """
+        return self.size == stat.st_size and self.mtime == stat.st_mtime
+
+    def set_state(self, size, mtime, digest, properties=None):
+        """
+        Stores the state of the file after a complete reading, or resets it
+        (None values) to force a new reading on the next modification
+        """
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        if properties is not None or digest is None:
+            self.properties = properties
+
 # ------------------------------------------------------------------------------
 
 @ComponentFactory("experiment-discovery-file-factory")
 @Provides(pelix.services.SERVICE_FILEINSTALL_LISTENERS)
 @Property('_watched_folder', pelix.services.PROP_FILEINSTALL_FOLDER)
+@Property('_cache_file', 'edef.cache.file', None)
 @Requires("_registry", pelix.remote.SERVICE_REGISTRY)
 class FileDiscovery(object):
     """
-    Discovery using EDEF files and FileInstall
+    Discovery using EDEF files and FileInstall.
+
+    Unchanged files (same size and modification time, or same content) are
+    not parsed again. The endpoints of a modified file are compared to the
+    previous ones, and only the differences are given to the registry.
+
+    If the "edef.cache.file" property is set, the properties read from the
+    files are stored in that cache file, which is loaded when the component is
+    validated: on restart, the files which haven't changed (same size and
+    modification time, or same content) are not parsed again.
+    The cache is read with pickle: it must be stored where only the user
+    running the framework can write.
     """
     def __init__(self):
         """
@@ -72,12 +226,29 @@ class FileDiscovery(object):
         # Import registry
         self._registry = None
 
-        # File name -> end point
-        self._endpoints = {}
+        # File name -> _EdefFile
+        self._files = {}
 
         # EDEF Parser
         self._parser = None
 
+        # Watched folder
+        self._watched_folder = None
+
+        # Cache file (no cache if empty)
+        self._cache_file = None
+
+        # File name -> (size, mtime, digest, properties), loaded from the
+        # cache of the watched folder
+        self.__cache = {}
+
+        # The initial scan of the folder has been done
+        self.__scanned = False
+
+        # Parsing processes, started by the first large initial scan
+        self.__pool = None
+        self.__pool_failed = False
+
 
     @Validate
     def _validate(self, context):
@@ -85,6 +256,7 @@ class FileDiscovery(object):
         Component validated
         """
         self._parser = edef.EDEFReader()
+        self.__load_cache()
 
 
     @Invalidate
@@ -93,7 +265,139 @@ class FileDiscovery(object):
         Component invalidated
         """
         self._parser = None
-        self._endpoints.clear()
+        self._files.clear()
+        self.__cache.clear()
+        self.__scanned = False
+
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+        self.__pool_failed = False
+
+
+    def __load_cache(self):
+        """
+        Loads the properties stored in the cache file
+        """
+        self.__cache.clear()
+        if not self._cache_file:
+            return
+
+        try:
+            with open(self._cache_file, 'rb') as filep:
+                cache = pickle.load(filep)
+
+        except (IOError, OSError, EOFError, pickle.UnpicklingError) as ex:
+            _logger.debug("No EDEF cache loaded: %s", ex)
+            return
+
+        except Exception as ex:
+            # Unpickling can raise almost anything
+            _logger.warning("Invalid EDEF cache file: %s", ex)
+            return
+
+        try:
+            if cache['format'] != CACHE_FORMAT \
+                    or cache['folder'] != self.__get_folder():
+                # Cache of another version or folder
+                _logger.debug("Ignoring the EDEF cache of %s",
+                              cache['folder'])
+                return
+
+            self.__cache.update(cache['files'])
+
+        except (KeyError, TypeError, ValueError) as ex:
+            _logger.warning("Invalid EDEF cache file: %s", ex)
+            return
+
+        _logger.debug("%d EDEF files loaded from the cache", len(self.__cache))
+
+
+    def __save_cache(self):
+        """
+        Writes the properties of the completely read files to the cache file
+        """
+        if not self._cache_file:
+            return
+
+        files = {}
+        for name, edef_file in self._files.items():
+            if edef_file.digest is not None \
+                    and edef_file.properties is not None:
+                files[name] = (edef_file.size, edef_file.mtime,
+                               edef_file.digest, edef_file.properties)
+
+        # Replace the file at once
+        tmp_file = self._cache_file + ".tmp"
+        try:
+            with open(tmp_file, 'wb') as filep:
+                pickle.dump({'format': CACHE_FORMAT,
+                             'folder': self.__get_folder(),
+                             'files': files}, filep, pickle.HIGHEST_PROTOCOL)
+
+            try:
+                os.rename(tmp_file, self._cache_file)
+
+            except OSError:
+                # Windows: can't rename over an existing file
+                os.remove(self._cache_file)
+                os.rename(tmp_file, self._cache_file)
+
+        except (IOError, OSError, TypeError, AttributeError,
+                pickle.PicklingError) as ex:
+            _logger.warning("Error writing the EDEF cache: %s", ex)
+
+
+    def __get_folder(self):
+        """
+        Returns the absolute path of the watched folder
+        """
+        return os.path.abspath(self._watched_folder or os.curdir)
+
+
+    def __load_cached(self, name, size, mtime, digest=None):
+        """
+        Updates the registry with the cached properties of a file seen for
+        the first time, if they are still valid
+
+        :param name: Name of the file
+        :param size: Current size of the file
+        :param mtime: Current modification time of the file
+        :param digest: Hash of the current content of the file, if known
+        :return: True if the cached properties have been used
+        """
+        try:
+            cached_size, cached_mtime, cached_digest, properties = \
+                                                            self.__cache[name]
+
+        except KeyError:
+            # Unknown file
+            return False
+
+        if size != cached_size or mtime != cached_mtime:
+            if digest is None:
+                # Compare the content hash before giving up
+                return False
+
+            elif digest != cached_digest:
+                # Modified file
+                del self.__cache[name]
+                return False
+
+        del self.__cache[name]
+
+        # Unpickled strings aren't shared anymore
+        properties = [intern_properties(props) for props in properties]
+        edef_file = self._files[name] = _EdefFile()
+        if self._update_endpoints(edef_file, self._to_endpoints(properties)):
+            edef_file.set_state(size, mtime, cached_digest, properties)
+
+        else:
+            edef_file.set_state(None, None, None)
+
+        return True
 
 
     def __filter_names(self, folder, names):
@@ -109,24 +413,267 @@ class FileDiscovery(object):
                 yield name, os.path.join(folder, name)
 
 
-    def _load_endpoints(self, path):
+    def _load_endpoints(self, source, properties=None):
         """
-        Loads the EDEF file at the given path
+        Loads the given EDEF file, one endpoint at a time
 
-        :param path: Path to the EDEF file
-        :return: The loaded endpoint file
+        :param source: Path to the EDEF file, or a file object
+        :param properties: If given, the list where to store the properties
+                           of the read endpoints
+        :return: A generator of the endpoints of the file, in the Pelix format
         :raise ValueError: Invalid EDEF file
         :raise IOError: Error reading file
         """
-        # Read the file content
-        with open(path, 'r') as filep:
-            xml_content = filep.read()
+        for endpoint in self._parser.iterparse(source):
+            if properties is not None:
+                properties.append(dict(endpoint.get_properties()))
+
+            yield beans.to_import(endpoint)
+
+
+    def _to_endpoints(self, properties):
+        """
+        Converts the properties read from an EDEF file to endpoints
+
+        :param properties: A list of EDEF endpoint properties
+        :return: A generator of endpoints, in the Pelix format
+        """
+        for props in properties:
+            yield beans.to_import(edef_beans.EndpointDescription(None, props))
+
+
+    def _load_file(self, name, path):
+        """
+        Loads a new or modified EDEF file and updates the registry according to
+        the changes in its endpoints
+
+        :param name: Name of the file
+        :param path: Path to the file
+        """
+        try:
+            stat = os.stat(path)
+
+        except OSError as ex:
+            _logger.debug("Can't access %s: %s", path, ex)
+            return
+
+        edef_file = self._files.get(name)
+        if edef_file is None:
+            if self.__load_cached(name, stat.st_size, stat.st_mtime):
+                # Unchanged since the cache was written
+                return
+
+        elif edef_file.is_same_stat(stat):
+            # Unchanged file
+            return
+
+        try:
+            with open(path, 'rb') as filep:
+                content = filep.read()
+
+        except IOError as ex:
+            _logger.debug("Can't read %s: %s", path, ex)
+            return
+
+        digest = hashlib.sha1(content).digest()
+        if edef_file is None:
+            if self.__load_cached(name, stat.st_size, stat.st_mtime, digest):
+                # Same content as the cached one
+                return
+
+            edef_file = self._files[name] = _EdefFile()
+
+        elif edef_file.digest == digest:
+            # Same content
+            edef_file.set_state(stat.st_size, stat.st_mtime, digest)
+            return
+
+        properties = []
+        if self._update_endpoints(edef_file, self._load_endpoints(
+                                            io.BytesIO(content), properties)):
+            edef_file.set_state(stat.st_size, stat.st_mtime, digest,
+                                properties)
+
+        else:
+            # Read it again on its next modification
+            edef_file.set_state(None, None, None)
+
+
+    def __get_pool(self):
+        """
+        Returns the parsing processes pool, starting it on first call.
+
+        The processes are started with the "forkserver" or "spawn" method, as
+        forking the framework process, which runs other threads, is unsafe.
+
+        :return: The process pool, or None if it can't be used
+        """
+        if self.__pool is not None or self.__pool_failed:
+            return self.__pool
+
+        try:
+            methods = multiprocessing.get_all_start_methods()
+
+        except AttributeError:
+            # Python < 3.4: processes can only be forked
+            _logger.debug("No safe start method for the parsing processes")
+            self.__pool_failed = True
+            return None
+
+        method = "forkserver" if "forkserver" in methods else "spawn"
+        try:
+            self.__pool = multiprocessing.get_context(method).Pool()
+
+        except (OSError, ImportError, ValueError, RuntimeError) as ex:
+            _logger.warning("Can't start the parsing processes: %s", ex)
+            self.__pool_failed = True
+
+        return self.__pool
+
+
+    def _load_files(self, files, parallel=False):
+        """
+        Loads new or modified EDEF files. If parallel is set and there are
+        enough of them, they are parsed in a process pool, then the registry
+        is updated with all the results at once.
+
+        :param files: A list of (name, path) tuples
+        :param parallel: If True, files can be parsed in the process pool
+        """
+        to_parse = []
+        for name, path in files:
+            try:
+                stat = os.stat(path)
+
+            except OSError as ex:
+                _logger.debug("Can't access %s: %s", path, ex)
+                continue
+
+            edef_file = self._files.get(name)
+            if edef_file is not None:
+                if edef_file.is_same_stat(stat):
+                    # Unchanged file
+                    continue
+
+                digest = edef_file.digest
+
+            elif self.__load_cached(name, stat.st_size, stat.st_mtime):
+                # Unchanged since the cache was written
+                continue
+
+            else:
+                # Let the parser compare the content with the cached one
+                digest = self.__cache.get(name, (None, None, None))[2]
+
+            to_parse.append((name, path, digest))
+
+        results = None
+        pool = None
+        if parallel and len(to_parse) >= PARALLEL_MIN_FILES:
+            pool = self.__get_pool()
+
+        if pool is not None:
+            try:
+                results = pool.map(_parse_file,
+                                   [(path, digest)
+                                    for _, path, digest in to_parse])
+
+            except Exception as ex:
+                _logger.warning("Error parsing EDEF files in parallel: %s", ex)
+
+        if results is None:
+            # Few files or error: parse them one by one
+            for name, path, _ in to_parse:
+                self._load_file(name, path)
+            return
+
+        for (name, _, _), result in zip(to_parse, results):
+            if result is not None:
+                self.__apply_result(name, result)
+
+
+    def __apply_result(self, name, result):
+        """
+        Updates the registry with the result of _parse_file()
+
+        :param name: Name of the file
+        :param result: A (size, mtime, digest, properties, error) tuple
+        """
+        size, mtime, digest, properties, error = result
+        edef_file = self._files.get(name)
+        if edef_file is None:
+            if properties is None:
+                # Same content as the cached one
+                self.__load_cached(name, size, mtime, digest)
+                return
+
+            edef_file = self._files[name] = _EdefFile()
+
+        elif properties is None:
+            # Same content
+            edef_file.set_state(size, mtime, digest)
+            return
+
+        if error is not None:
+            _logger.debug("Error reading EDEF file %s: %s", name, error)
+
+        # Strings from the pool processes aren't shared anymore
+        properties = [intern_properties(props) for props in properties]
+        if self._update_endpoints(edef_file, self._to_endpoints(properties),
+                                  error is None):
+            edef_file.set_state(size, mtime, digest, properties)
+
+        else:
+            # Read it again on its next modification
+            edef_file.set_state(None, None, None)
+
+
+    def _update_endpoints(self, edef_file, endpoints, complete=True):
+        """
+        Updates the registry with the endpoints read from a file.
+        If the file is invalid, the endpoints read before the error are kept
+        and the file will be read again on its next modification.
+
+        :param edef_file: The _EdefFile bean describing the file
+        :param endpoints: An iterable of the endpoints of the file
+        :param complete: False if the file couldn't be parsed completely
+        :return: True if the file has been completely read
+        """
+        old_endpoints = edef_file.endpoints
+        new_endpoints = {}
+        try:
+            for endpoint in endpoints:
+                uid = endpoint.uid
+                signature = _signature(endpoint.properties)
+                new_endpoints[uid] = (signature, endpoint)
+
+                try:
+                    old_signature = old_endpoints[uid][0]
+
+                except KeyError:
+                    # New endpoint
+                    self._registry.add(endpoint)
+
+                else:
+                    if old_signature != signature:
+                        # Modified endpoint
+                        self._registry.update(uid, endpoint.properties)
+
+        except (IOError, ValueError) as ex:
+            _logger.debug("Error reading an EDEF file: %s", ex)
+            complete = False
 
-        # Parse the end points
-        edef_endpoints = self._parser.parse(xml_content)
+        if not complete:
+            # Invalid file: keep what has been read
+            old_endpoints.update(new_endpoints)
+            return False
 
-        # Convert them to the Pelix format
-        return [beans.to_import(endpoint) for endpoint in edef_endpoints]
+        for uid in set(old_endpoints).difference(new_endpoints):
+            # Removed endpoint
+            self._registry.remove(uid)
+
+        edef_file.endpoints = new_endpoints
+        return True
 
 
     def folder_change(self, folder, added, updated, deleted):
@@ -138,31 +685,103 @@ class FileDiscovery(object):
         :param updated: List of modified files
         :param deleted: List of deleted files
         """
-        for name, path in self.__filter_names(folder, added):
-            try:
-                # Add new endpoints
-                endpoints = self._load_endpoints(path)
-                for endpoint in endpoints:
-                    # Import the service
-                    self._registry.add(endpoint)
-
-                self._endpoints[name] = endpoints
-
-            except (IOError, ValueError):
-                # Not an EDEF file
-                pass
-
-        for name, path in self.__filter_names(folder, updated):
-            # TODO: Update end point
-            pass
+        # Parse new and modified files (in parallel on initial scan)
+        files = list(self.__filter_names(folder, added))
+        files.extend(self.__filter_names(folder, updated))
+        self._load_files(files, not self.__scanned)
+        self.__scanned = True
 
+        changed = bool(files)
         for name, _ in self.__filter_names(folder, deleted):
             try:
                 # Remove endpoints
-                endpoints = self._endpoints.pop(name)
-                for endpoint in endpoints:
-                    self._registry.remove(endpoint)
+                edef_file = self._files.pop(name)
 
             except KeyError:
                 # Wasn't an EDEF file
-                pass
+                continue
+
+            changed = True
+            for uid in edef_file.endpoints:
+                self._registry.remove(uid)
+
+        if changed:
+            self.__save_cache()
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    # Compares the serial, parallel and cached loading of a synthetic EDEF
+    # folder
+    import shutil
+    import sys
+    import tempfile
+    import time
+
+    # Use the module by its name, for the pool processes to find _parse_file
+    import experiment.disco_file as module
+
+    class _CountingRegistry(object):
+        """
+        Imports registry counting added endpoints
+        """
+        def __init__(self):
+            self.count = 0
+
+        def add(self, endpoint):
+            self.count += 1
+            return True
+
+        def update(self, uid, properties):
+            pass
+
+        def remove(self, uid):
+            pass
+
+    nb_files = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    nb_endpoints = 5
+
+    folder = tempfile.mkdtemp(prefix="edef-bench-")
+    cache_file = folder + ".cache"
+    try:
+        writer = edef.EDEFWriter()
+        for file_idx in range(nb_files):
+            endpoints = []
+            for endpoint_idx in range(nb_endpoints):
+                uid = "endpoint-{0}-{1}".format(file_idx, endpoint_idx)
+                endpoints.append(edef_beans.EndpointDescription(None, {
+                    pelix.remote.PROP_ENDPOINT_ID: uid,
+                    pelix.remote.PROP_ENDPOINT_FRAMEWORK_UUID: "framework",
+                    pelix.remote.PROP_ENDPOINT_SERVICE_ID: endpoint_idx,
+                    pelix.remote.PROP_IMPORTED_CONFIGS: ["ecf.jabsorb"],
+                    pelix.constants.OBJECTCLASS: ["sample.spec"],
+                    pelix.remote.PROP_INTENTS: ["SOAP", "HTTP"],
+                    "ecf.jabsorb.name": uid}))
+
+            writer.write(endpoints, os.path.join(folder,
+                                                 "{0}.xml".format(file_idx)))
+
+        names = sorted(os.listdir(folder))
+        for title, parallel_min, cache in (
+                ("serial", len(names) + 1, None),
+                ("parallel", PARALLEL_MIN_FILES, None),
+                ("no cache", PARALLEL_MIN_FILES, cache_file),
+                ("cached", PARALLEL_MIN_FILES, cache_file)):
+            module.PARALLEL_MIN_FILES = parallel_min
+            discovery = module.FileDiscovery()
+            discovery._registry = _CountingRegistry()
+            discovery._watched_folder = folder
+            discovery._cache_file = cache
+            discovery._validate(None)
+
+            start = time.time()
+            discovery.folder_change(folder, names, [], [])
+            print("{0:<9}: {1} files, {2} endpoints in {3:.2f}s".format(
+                        title, nb_files, discovery._registry.count,
+                        time.time() - start))
+            discovery._invalidate(None)
+
+    finally:
+        shutil.rmtree(folder)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
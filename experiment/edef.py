@@ -39,6 +39,7 @@ __docformat__ = "restructuredtext en"
 # ------------------------------------------------------------------------------
 
 # Local
+from experiment.interning import intern_string, intern_value
 import experiment.beans as beans
 
 # Pelix
@@ -46,15 +47,8 @@ import pelix.constants
 import pelix.remote
 
 # Standard library
-try:
-    # Python 2
-    import StringIO
-    StringIO = StringIO.StringIO
-
-except ImportError:
-    # Python 3
-    import io
-    StringIO = io.StringIO
+from xml.sax.saxutils import escape
+import codecs
 
 try:
     # C version
@@ -63,6 +57,14 @@ except ImportError:
     # Fall back
     import xml.etree.ElementTree as ElementTree
 
+try:
+    # Python 2
+    _TEXT_TYPE = unicode
+
+except NameError:
+    # Python 3
+    _TEXT_TYPE = str
+
 # ------------------------------------------------------------------------------
 
 # EDEF XML name space
@@ -109,6 +111,89 @@ TYPED_STRING = (pelix.constants.OBJECTCLASS,
 # Special case: XML value given
 XML_VALUE = object()
 
+# Type of XML elements
+_ELEMENT_TYPE = type(ElementTree.Element(None))
+
+# Entities to escape in attribute values (quotes and normalized white spaces)
+_ATTRIBUTE_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;",
+                       "\t": "&#9;"}
+
+# ------------------------------------------------------------------------------
+
+def _convert_string(value):
+    """
+    Converts a String value
+    """
+    return value.strip()
+
+
+def _convert_boolean(value):
+    """
+    Converts a boolean value
+    """
+    return value.strip().lower() not in ("false", "0")
+
+
+def _convert_char(value):
+    """
+    Converts a character value
+    """
+    return value.strip()[0]
+
+
+# Value type -> converter (int() and float() ignore surrounding spaces)
+_CONVERTERS = {TYPE_STRING: _convert_string}
+_CONVERTERS.update((vtype, int) for vtype in TYPES_INT)
+_CONVERTERS.update((vtype, float) for vtype in TYPES_FLOAT)
+_CONVERTERS.update((vtype, _convert_boolean) for vtype in TYPES_BOOLEAN)
+_CONVERTERS.update((vtype, _convert_char) for vtype in TYPES_CHAR)
+
+
+def _get_converter(vtype):
+    """
+    Returns the converter for the given value type
+
+    :param vtype: Type of the value
+    :return: A method converting a value string
+    :raise ValueError: Unknown value type
+    """
+    try:
+        return _CONVERTERS[vtype]
+
+    except KeyError:
+        raise ValueError("Unknown value type: {0}".format(vtype))
+
+
+def _to_text(value):
+    """
+    Returns the text form of a value
+    """
+    if isinstance(value, _TEXT_TYPE):
+        return value
+
+    return _TEXT_TYPE(value)
+
+
+def _quote(value):
+    """
+    Escapes the given string and surrounds it with quotes, to be used as an
+    attribute value
+    """
+    return '"{0}"'.format(escape(value, _ATTRIBUTE_ENTITIES))
+
+
+def _to_xml(element):
+    """
+    Returns the XML string of the given element, without its tail
+    """
+    tail = element.tail
+    element.tail = None
+    try:
+        return ElementTree.tostring(element).decode("ascii")
+
+    finally:
+        element.tail = tail
+
 # ------------------------------------------------------------------------------
 
 class EDEFReader(object):
@@ -124,28 +209,7 @@ class EDEFReader(object):
         :return: The converted value
         :raise ValueError: Conversion failed
         """
-        # Normalize value
-        value = value.strip()
-
-        if vtype == TYPE_STRING:
-            # Nothing to do
-            return value
-
-        elif vtype in TYPES_INT:
-            return int(value)
-
-        elif vtype in TYPES_FLOAT:
-            return float(value)
-
-        elif vtype in TYPES_BOOLEAN:
-            # Compare lower-case value
-            return value.lower() not in ("false", "0")
-
-        elif vtype in TYPES_CHAR:
-            return value[0]
-
-        # No luck
-        raise ValueError("Unknown value type: {0}".format(vtype))
+        return _get_converter(vtype)(value)
 
 
     def _parse_description(self, node):
@@ -174,19 +238,22 @@ class EDEFReader(object):
         :raise KeyError: Attribute missing
         """
         # Get informations
-        name = node.attrib[ATTR_NAME]
-        vtype = node.attrib.get(ATTR_VALUE_TYPE, TYPE_STRING)
+        attributes = node.attrib
+        name = attributes[ATTR_NAME]
+        vtype = attributes.get(ATTR_VALUE_TYPE, TYPE_STRING)
 
-        # Look for a value as a single child node
-        try:
-            value_node = next(iter(node))
-            value = self._parse_value_node(vtype, value_node)
+        value = attributes.get(ATTR_VALUE)
+        if value is not None:
+            # Value is an attribute (most common case)
+            return intern_string(name), \
+                intern_value(_get_converter(vtype)(value))
 
-        except StopIteration:
-            # Value is an attribute
-            value = self._convert_value(vtype, node.attrib[ATTR_VALUE])
+        elif len(node):
+            # Value as a single child node
+            return intern_string(name), \
+                intern_value(self._parse_value_node(vtype, node[0]))
 
-        return name, value
+        raise KeyError(ATTR_VALUE)
 
 
     def _parse_value_node(self, vtype, node):
@@ -204,12 +271,14 @@ class EDEFReader(object):
 
         elif kind in (TAG_ARRAY, TAG_LIST):
             # List
-            return [self._convert_value(vtype, value_node.text)
+            convert = _get_converter(vtype)
+            return [convert(value_node.text)
                     for value_node in node.findall(TAG_VALUE)]
 
         elif kind == TAG_SET:
             # Set
-            return set(self._convert_value(vtype, value_node.text)
+            convert = _get_converter(vtype)
+            return set(convert(value_node.text)
                        for value_node in node.findall(TAG_VALUE))
 
         else:
@@ -217,6 +286,46 @@ class EDEFReader(object):
             raise ValueError("Unknown value tag: {0}".format(kind))
 
 
+    def iterparse(self, source):
+        """
+        Parses an EDEF XML file or stream, one endpoint description at a time.
+        The parsed description nodes are removed from the document, so that
+        memory use is bounded by the size of a single description.
+
+        :param source: A file name or a file object
+        :return: A generator of EndpointDescription beans
+        :raise ValueError: Invalid EDEF XML
+        :raise IOError: Error reading the file
+        """
+        root = None
+        depth = 0
+        try:
+            for event, node in ElementTree.iterparse(source,
+                                                     ('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        # First node
+                        if node.tag != TAG_ENDPOINT_DESCRIPTIONS:
+                            raise ValueError("Not an EDEF XML: {0}"
+                                             .format(node.tag))
+                        root = node
+
+                    depth += 1
+                    continue
+
+                depth -= 1
+                if depth == 1 and node.tag == TAG_ENDPOINT_DESCRIPTION:
+                    # Complete description
+                    endpoint = self._parse_description(node)
+
+                    # Forget the parsed nodes
+                    root.clear()
+                    yield endpoint
+
+        except ElementTree.ParseError as ex:
+            raise ValueError("Invalid EDEF XML: {0}".format(ex))
+
+
     def parse(self, xml_str):
         """
         Parses an EDEF XML string
@@ -237,52 +346,19 @@ class EDEFReader(object):
 
 class EDEFWriter(object):
     """
-    EDEF XML file writer
-    """
-    def _indent(self, element, level=0, prefix='\t'):
-        """
-        In-place Element text auto-indent, for pretty printing.
-
-        Code from: http://effbot.org/zone/element-lib.htm#prettyprint
-
-        :param element: An Element object
-        :param level: Level of indentation
-        :param prefix: String to use for each indentation
-        """
-        element_prefix = "\r\n{0}".format(level * prefix)
+    EDEF XML file writer.
 
-        if len(element):
-            if not element.text or not element.text.strip():
-                element.text = element_prefix + prefix
-
-            if not element.tail or not element.tail.strip():
-                element.tail = element_prefix
-
-            # Yep, let the "element" variable be overwritten
-            for element in element:
-                self._indent(element, level + 1, prefix)
-
-            # Tail of the last child
-            if not element.tail or not element.tail.strip():
-                element.tail = element_prefix
-
-        else:
-            if level and (not element.tail or not element.tail.strip()):
-                element.tail = element_prefix
-
-
-    def _add_container(self, props_node, tag, container):
+    The XML document is written incrementally, one endpoint description at a
+    time, with its indentation.
+    """
+    def __init__(self, indent="\t"):
         """
-        Walks through the given container and fills the node
+        Sets up the writer
 
-        :param props_node: A property node
-        :param tag: Name of the container tag
-        :param container: The container
+        :param indent: String used for each indentation level, or None to
+                       write the document on a single line
         """
-        values_node = ElementTree.SubElement(props_node, tag)
-        for value in container:
-            value_node = ElementTree.SubElement(values_node, TAG_VALUE)
-            value_node.text = str(value)
+        self._indent = indent
 
 
     def _get_type(self, name, value):
@@ -323,7 +399,7 @@ class EDEFWriter(object):
             # Float
             return TYPE_DOUBLE
 
-        elif isinstance(value, type(ElementTree.Element(None))):
+        elif isinstance(value, _ELEMENT_TYPE):
             # XML
             return XML_VALUE
 
@@ -331,72 +407,100 @@ class EDEFWriter(object):
         return TYPE_STRING
 
 
-    def _make_endpoint(self, root_node, endpoint):
+    def _prefix(self, level):
+        """
+        Returns the string to write before a tag of the given level
         """
-        Converts the given endpoint bean to an XML Element
+        if self._indent is None:
+            return ""
+
+        return "\n" + self._indent * level
+
+
+    def _make_endpoint(self, endpoint):
+        """
+        Converts the given endpoint bean to its XML form
 
-        :param root_node: The XML root Element
         :param endpoint: An EndpointDescription bean
-        :return: An Element
+        :return: A list of strings
         """
-        endpoint_node = ElementTree.SubElement(root_node,
-                                               TAG_ENDPOINT_DESCRIPTION)
+        prefix = self._prefix(2)
+        value_prefix = self._prefix(4)
+        lines = [self._prefix(1), "<endpoint-description>"]
 
         for name, value in endpoint.get_properties().items():
             # Compute value type
             vtype = self._get_type(name, value)
 
-            # Prepare the property node
-            prop_node = ElementTree.SubElement(endpoint_node, TAG_PROPERTY,
-                                               {ATTR_NAME: name})
-
+            lines.append('{0}<property name={1}'.format(prefix,
+                                                        _quote(name)))
             if vtype == XML_VALUE:
                 # Special case, we have to store the value as a child
                 # without a value-type attribute
-                prop_node.append(value)
+                lines.extend((">", self._prefix(3), "<xml>", value_prefix,
+                              _to_xml(value), self._prefix(3), "</xml>",
+                              prefix, "</property>"))
                 continue
 
             # Set the value type
-            prop_node.set(ATTR_VALUE_TYPE, vtype)
+            lines.append(' value-type="{0}"'.format(vtype))
 
             # Compute value node or attribute
             if isinstance(value, tuple):
                 # Array
-                self._add_container(prop_node, TAG_ARRAY, value)
+                tag = "array"
 
             elif isinstance(value, list):
                 # List
-                self._add_container(prop_node, TAG_LIST, value)
+                tag = "list"
 
             elif isinstance(value, set):
                 # Set
-                self._add_container(prop_node, TAG_SET, value)
-
-            elif isinstance(value, type(root_node)):
-                # XML (direct addition)
-                prop_node.append(value)
+                tag = "set"
 
             else:
                 # Simple value -> Attribute
-                prop_node.set(ATTR_VALUE, str(value))
+                lines.append(' value={0} />'.format(_quote(_to_text(value))))
+                continue
+
+            lines.extend((">", self._prefix(3), "<", tag, ">"))
+            for item in value:
+                lines.extend((value_prefix, "<value>",
+                              escape(_to_text(item)), "</value>"))
+
+            lines.extend((self._prefix(3), "</", tag, ">",
+                          prefix, "</property>"))
 
+        lines.extend((self._prefix(1), "</endpoint-description>"))
+        return lines
 
-    def _make_xml(self, endpoints):
+
+    def _dump(self, endpoints, write):
         """
-        Converts the given endpoint description beans into an XML Element
+        Writes the XML document describing the given endpoints
 
-        :param endpoints: A list of EndpointDescription beans
-        :return: A string containing an XML document
+        :param endpoints: An iterable of EndpointDescription beans
+        :param write: Method called with each part of the document
         """
-        root = ElementTree.Element(TAG_ENDPOINT_DESCRIPTIONS)
+        write('<?xml version="1.0" encoding="UTF-8"?>{0}'
+              '<endpoint-descriptions xmlns="{1}">'
+              .format(self._prefix(0), EDEF_NAMESPACE))
 
         for endpoint in endpoints:
-            self._make_endpoint(root, endpoint)
+            # Single call per endpoint
+            write("".join(self._make_endpoint(endpoint)))
 
-        # Prepare pretty-printing
-        self._indent(root)
+        write("{0}</endpoint-descriptions>{0}".format(self._prefix(0)))
 
-        return root
+
+    def dump(self, endpoints, output):
+        """
+        Writes the given endpoint descriptions to the given stream
+
+        :param endpoints: An iterable of EndpointDescription beans
+        :param output: A text file-like object
+        """
+        self._dump(endpoints, output.write)
 
 
     def to_string(self, endpoints):
@@ -406,32 +510,9 @@ class EDEFWriter(object):
         :param endpoints: A list of EndpointDescription beans
         :return: A string containing an XML document
         """
-        # Make the ElementTree
-        root = self._make_xml(endpoints)
-        tree = ElementTree.ElementTree(root)
-
-        # Force the default name space
-        ElementTree.register_namespace("", EDEF_NAMESPACE)
-
-        # Make the XML
-        for encoding in ('unicode', 'UTF-8'):
-            # Prepare a StringIO output
-            output = StringIO()
-
-            try:
-                # Try to write with a correct encoding
-                tree.write(output, encoding=encoding, xml_declaration=True,
-                           method="xml")
-                break
-
-            except LookupError:
-                # 'unicode' is needed in Python 3, but unknown in Python 2...
-                continue
-
-        else:
-            raise LookupError("Couldn't find a valid encoding")
-
-        return output.getvalue()
+        parts = []
+        self._dump(endpoints, parts.append)
+        return "".join(parts)
 
 
     def write(self, endpoints, filename):
@@ -442,8 +523,8 @@ class EDEFWriter(object):
         :param filename: Name of the file where to write the XML
         :raise IOError: Error writing the file
         """
-        with open(filename, "w") as fp:
-            fp.write(self.to_string(endpoints))
+        with codecs.open(filename, "w", "UTF-8") as filep:
+            self.dump(endpoints, filep)
 
 # ------------------------------------------------------------------------------
 
@@ -466,9 +547,39 @@ if __name__ == "__main__":
         print("Endpoint:", str(endpoint))
         print("Properties:")
         from pprint import pprint
-        pprint(endpoint.get_properties())
+        pprint(dict(endpoint.get_properties()))
 
     # Print its "written" form
     print("-" * 40)
     writer = EDEFWriter()
     print(writer.to_string(endpoints))
+
+    # Benchmark: the sample description repeated many times
+    import timeit
+    header, body = xml_str.split("<endpoint-description>", 1)
+    body, footer = body.rsplit("</endpoint-description>", 1)
+    description = "<endpoint-description>{0}</endpoint-description>" \
+                  .format(body)
+    nb_descriptions = 5000
+    big_xml = "".join((header, description * nb_descriptions, footer))
+
+    def bench(method):
+        """
+        Returns the best time of 5 runs of the given method
+        """
+        return min(timeit.repeat(method, number=1, repeat=5))
+
+    # Same document, read from a string or as a stream
+    import io
+    big_data = big_xml.encode("UTF-8")
+    parsed = reader.parse(big_xml)
+
+    print("-" * 40)
+    print("{0} endpoint descriptions:".format(nb_descriptions))
+    print("parse     : {0:.3f}s".format(bench(lambda: reader.parse(big_xml))))
+    print("iterparse : {0:.3f}s".format(
+        bench(lambda: list(reader.iterparse(io.BytesIO(big_data))))))
+    print("to_string : {0:.3f}s".format(
+        bench(lambda: writer.to_string(parsed))))
+    print("dump      : {0:.3f}s".format(
+        bench(lambda: writer.dump(parsed, io.StringIO()))))
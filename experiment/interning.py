@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Pelix remote services: interning of endpoint properties
+
+Endpoint properties decoded by the discovery services share the same keys and
+a lot of values (framework UUIDs, specifications, configurations...), but each
+decoding creates new string objects. Interning them makes all endpoints share
+a single copy of each string.
+
+:author: Thomas Calmant
+:copyright: Copyright 2013, isandlaTech
+:license: Apache License 2.0
+:version: 0.1
+:status: Alpha
+
+..
+
+    Copyright 2013 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 1, 0)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+try:
+    # Python 3
+    from sys import intern as _intern
+
+except ImportError:
+    # Python 2: built-in (only accepts str, not unicode)
+    _intern = intern
+
+# ------------------------------------------------------------------------------
+
+MAX_INTERNED_LENGTH = 256
+""" Longer strings (serialized objects, XML...) are not interned """
+
+# ------------------------------------------------------------------------------
+
+def intern_string(value):
+    """
+    Returns the interned version of the given string, or the value itself if
+    it can't be interned
+
+    :param value: A string
+    :return: The shared instance of the string
+    """
+    if type(value) is str and len(value) <= MAX_INTERNED_LENGTH:
+        return _intern(value)
+
+    return value
+
+
+def intern_value(value):
+    """
+    Interns the strings of a property value
+
+    :param value: A property value
+    :return: The value, with interned strings
+    """
+    value_type = type(value)
+    if value_type is str:
+        return intern_string(value)
+
+    elif value_type is list:
+        return [intern_value(item) for item in value]
+
+    elif value_type is tuple:
+        return tuple(intern_value(item) for item in value)
+
+    elif value_type is set:
+        return set(intern_value(item) for item in value)
+
+    elif value_type is dict:
+        return intern_properties(value)
+
+    # Other types are kept as is
+    return value
+
+
+def intern_properties(properties):
+    """
+    Interns the keys and the string values of a properties dictionary
+
+    :param properties: A dictionary
+    :return: A new dictionary, with interned strings
+    """
+    return dict((intern_string(key), intern_value(value))
+                for key, value in properties.items())
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    # Memory retained by the endpoints of a discovery service, built from
+    # decoded properties with and without interning
+    import gc
+    import json
+    import tracemalloc
+    import uuid
+
+    import experiment.beans
+    import pelix.remote.beans
+
+    def load(data):
+        """
+        Decodes properties without interning them
+        """
+        return json.loads(data)
+
+    def load_interned(data):
+        """
+        Decodes properties and interns them, as the discovery services do
+        """
+        return intern_properties(json.loads(data))
+
+    nb_endpoints = 10000
+    frameworks = [str(uuid.uuid4()) for _ in range(20)]
+
+    # JSON content of each endpoint, as stored in a discovery node
+    contents = []
+    for idx in range(nb_endpoints):
+        framework = frameworks[idx % len(frameworks)]
+        contents.append(json.dumps({
+            "objectClass": ["sample.spec.{0}".format(idx % 50)],
+            "endpoint.id": str(uuid.uuid4()),
+            "endpoint.framework.uuid": framework,
+            "endpoint.service.id": idx,
+            "service.imported.configs": ["ecf.jabsorb", "jsonrpc"],
+            "service.intents": ["passByValue", "exactlyOnce"],
+            "ecf.jabsorb.accesses": "http://host-{0}:8080/JABSORB-RPC"
+                                    .format(idx % len(frameworks)),
+            "ecf.endpoint.id.ns": "ecf.namespace.jabsorb"}))
+
+    for title, decode in (("plain", load), ("interned", load_interned)):
+        gc.collect()
+        tracemalloc.start()
+
+        # Keep the import endpoints only, as an importer would: the decoded
+        # dictionaries and the descriptions are released
+        endpoints = [pelix.remote.beans.to_import(
+                        experiment.beans.EndpointDescription(None,
+                                                             decode(data)))
+                     for data in contents]
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print("{0:<8}: {1} endpoints, {2:.0f} bytes per endpoint"
+              .format(title, len(endpoints), size / float(nb_endpoints)))
+        del endpoints
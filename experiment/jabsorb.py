@@ -38,6 +38,7 @@ __version__ = ".".join(str(x) for x in __version_info__)
 # Standard library
 import inspect
 import re
+import uuid
 
 # ------------------------------------------------------------------------------
 
@@ -62,6 +63,28 @@ JAVA_LISTS_PATTERN = re.compile(r"java\.util\..*List")
 JAVA_SETS_PATTERN = re.compile(r"java\.util\..*Set")
 """ Pattern to detect standard Java classes for sets """
 
+BINARY_PART = "__binary_part__"
+"""
+Dictionary key of the placeholder of a binary value, associated to the index of
+the multipart section holding its content
+"""
+
+MULTIPART_MIXED = "multipart/mixed"
+""" MIME type of requests and responses with binary sections """
+
+# Types transferred as binary sections (BINARY_TYPES) and types of the values
+# the Jabsorb conversion keeps as is (SCALAR_TYPES)
+if bytes is str:
+    # Python 2: bytes are strings, only consider explicit buffers
+    BINARY_TYPES = (bytearray, memoryview)
+    SCALAR_TYPES = frozenset((str, unicode, int, long, float, bool,
+                              type(None)))
+
+else:
+    # Python 3
+    BINARY_TYPES = (bytes, bytearray, memoryview)
+    SCALAR_TYPES = frozenset((str, int, float, bool, type(None)))
+
 # ------------------------------------------------------------------------------
 
 class __hashabledict(dict):
@@ -128,6 +151,39 @@ def _is_builtin(obj):
     else:
         return module.__name__ in ('', '__main__')
 
+def _is_plain(value, containers):
+    """
+    Checks if the given value only contains scalars, in the given kind of
+    containers, i.e. if the Jabsorb conversion would not modify it.
+    Exact types are tested: sub-classes might carry a Java class hint.
+
+    :param value: The value to check
+    :param containers: Set of container types allowed
+    :return: True if the value can be used as is
+    """
+    value_type = type(value)
+    if value_type in SCALAR_TYPES:
+        return True
+
+    elif value_type in containers:
+        for entry in value:
+            entry_type = type(entry)
+            if entry_type not in SCALAR_TYPES \
+                    and not (entry_type in containers
+                             and _is_plain(entry, containers)):
+                return False
+
+        return True
+
+    return False
+
+
+_TO_JABSORB_PLAIN = frozenset((tuple,))
+""" Containers left untouched by to_jabsorb (arrays) """
+
+_FROM_JABSORB_PLAIN = frozenset((list,))
+""" Containers equivalent after from_jabsorb (JSON arrays) """
+
 # ------------------------------------------------------------------------------
 
 def to_jabsorb(value):
@@ -137,6 +193,21 @@ def to_jabsorb(value):
     Converts maps and lists to a jabsorb form.
     Keeps tuples as is, to let them be considered as arrays.
 
+    :param value: A Python result to send to Jabsorb
+    :return: The result in a Jabsorb map format (not a JSON object)
+    """
+    if _is_plain(value, _TO_JABSORB_PLAIN):
+        # Nothing to convert (most calls)
+        return value
+
+    return _to_jabsorb(value)
+
+
+def _to_jabsorb(value):
+    """
+    Converts the given value to the Jabsorb format, without checking if it
+    is plain first
+
     :param value: A Python result to send to Jabsorb
     :return: The result in a Jabsorb map format (not a JSON object)
     """
@@ -152,7 +223,7 @@ def to_jabsorb(value):
             converted_result = {}
 
             for key, content in value.items():
-                converted_result[key] = to_jabsorb(content)
+                converted_result[key] = _to_jabsorb(content)
 
             try:
                 # Keep the raw jsonrpclib information
@@ -165,7 +236,7 @@ def to_jabsorb(value):
             converted_result = {JAVA_CLASS: "java.util.HashMap"}
             converted_result["map"] = map_pairs = {}
             for key, content in value.items():
-                map_pairs[key] = to_jabsorb(content)
+                map_pairs[key] = _to_jabsorb(content)
 
             try:
                 # Keep the raw jsonrpclib information
@@ -177,20 +248,20 @@ def to_jabsorb(value):
     # List ? (consider tuples as an array)
     elif isinstance(value, list):
         converted_result = {JAVA_CLASS: "java.util.ArrayList"}
-        converted_result["list"] = [to_jabsorb(entry) for entry in value]
+        converted_result["list"] = [_to_jabsorb(entry) for entry in value]
 
     # Set ?
     elif isinstance(value, (set, frozenset)):
         converted_result = {JAVA_CLASS: "java.util.HashSet"}
-        converted_result["set"] = [to_jabsorb(entry) for entry in value]
+        converted_result["set"] = [_to_jabsorb(entry) for entry in value]
 
     # Tuple ? (used as array, except if it is empty)
     elif isinstance(value, tuple):
-        converted_result = [to_jabsorb(entry) for entry in value]
+        converted_result = [_to_jabsorb(entry) for entry in value]
 
     elif hasattr(value, JAVA_CLASS):
         # Class with a Java class hint: convert into a dictionary
-        converted_result = __hashabledict((name, to_jabsorb(content))
+        converted_result = __hashabledict((name, _to_jabsorb(content))
                                           for name, content
             in map(lambda name: (name, getattr(value, name)), dir(value))
             if not name.startswith('_') and not inspect.ismethod(content))
@@ -213,12 +284,26 @@ def from_jabsorb(request):
     Transforms a jabsorb request into a more Python data model (converts maps
     and lists)
 
+    :param request: Data coming from Jabsorb
+    :return: A Python representation of the given data
+    """
+    if _is_plain(request, _FROM_JABSORB_PLAIN):
+        # Nothing to convert (most calls)
+        return request
+
+    return _from_jabsorb(request)
+
+
+def _from_jabsorb(request):
+    """
+    Converts the given Jabsorb data, without checking if it is plain first
+
     :param request: Data coming from Jabsorb
     :return: A Python representation of the given data
     """
     if isinstance(request, (list, set, frozenset, tuple)):
         # Special case : JSON arrays (Python lists)
-        return [from_jabsorb(element) for element in request]
+        return [_from_jabsorb(element) for element in request]
 
     elif isinstance(request, dict):
         # Dictionary
@@ -227,21 +312,21 @@ def from_jabsorb(request):
         if java_class:
             # Java Map ?
             if JAVA_MAPS_PATTERN.match(java_class) is not None:
-                return __hashabledict((from_jabsorb(key), from_jabsorb(value))
+                return __hashabledict((_from_jabsorb(key), _from_jabsorb(value))
                                       for key, value in request["map"].items())
 
             # Java List ?
             elif JAVA_LISTS_PATTERN.match(java_class) is not None:
-                return __hashablelist(from_jabsorb(element)
+                return __hashablelist(_from_jabsorb(element)
                                       for element in request["list"])
 
             # Java Set ?
             elif JAVA_SETS_PATTERN.match(java_class) is not None:
-                return __hashableset(from_jabsorb(element)
+                return __hashableset(_from_jabsorb(element)
                                      for element in request["set"])
 
         # Any other case
-        return __hashabledict((from_jabsorb(key), from_jabsorb(value))
+        return __hashabledict((_from_jabsorb(key), _from_jabsorb(value))
                               for key, value in request.items())
 
     elif not _is_builtin(request):
@@ -250,10 +335,192 @@ def from_jabsorb(request):
             # Only convert public fields
             if not attr[0] == '_':
                 # Field conversion
-                setattr(request, attr, from_jabsorb(getattr(request, attr)))
+                setattr(request, attr, _from_jabsorb(getattr(request, attr)))
 
         return request
 
     else:
         # Any other case
         return request
+
+# ------------------------------------------------------------------------------
+
+def extract_binaries(value, parts):
+    """
+    Replaces the binary values found in the given Jabsorb data by placeholders,
+    and appends them to the given list of parts
+
+    :param value: Data in Jabsorb format (result of to_jabsorb())
+    :param parts: The list of binary parts to fill
+    :return: The data with placeholders
+    """
+    if isinstance(value, BINARY_TYPES):
+        parts.append(value)
+        return {BINARY_PART: len(parts) - 1}
+
+    elif isinstance(value, (list, tuple)):
+        return [extract_binaries(entry, parts) for entry in value]
+
+    elif isinstance(value, dict):
+        return dict((key, extract_binaries(content, parts))
+                    for key, content in value.items())
+
+    return value
+
+
+def inject_binaries(value, parts):
+    """
+    Replaces the binary placeholders found in the given data by the
+    corresponding parts
+
+    :param value: Data with placeholders
+    :param parts: The list of binary parts (memoryview objects)
+    :return: The data with binary values
+    :raise ValueError: Invalid part index
+    """
+    if isinstance(value, list):
+        # Lists (and sub-classes) are updated in place
+        for idx, entry in enumerate(value):
+            value[idx] = inject_binaries(entry, parts)
+
+    elif isinstance(value, dict):
+        if len(value) == 1 and BINARY_PART in value:
+            index = value[BINARY_PART]
+            if type(index) is not int or not 0 <= index < len(parts):
+                # Don't accept negative indices either
+                raise ValueError("Invalid binary part index: {0!r}"
+                                 .format(index))
+
+            return parts[index]
+
+        for key, content in value.items():
+            value[key] = inject_binaries(content, parts)
+
+    return value
+
+
+def has_binaries(value):
+    """
+    Checks if the given data contains binary values
+
+    :param value: Data in Jabsorb format
+    :return: True if a binary value was found
+    """
+    if isinstance(value, BINARY_TYPES):
+        return True
+
+    elif isinstance(value, (list, tuple)):
+        return any(has_binaries(entry) for entry in value)
+
+    elif isinstance(value, dict):
+        return any(has_binaries(content) for content in value.values())
+
+    return False
+
+
+def make_multipart(json_body, parts):
+    """
+    Prepares the sections of a multipart body: the JSON content then the binary
+    parts. The parts are not copied: the caller must send each chunk in turn.
+
+    :param json_body: The JSON-RPC body (bytes)
+    :param parts: The binary parts
+    :return: A (content type, chunks, total length) tuple
+    """
+    boundary = uuid.uuid4().hex.encode('ascii')
+    delimiter = b'--' + boundary
+
+    chunks = [delimiter,
+              b'\r\nContent-Type: application/json-rpc\r\nContent-Length: ',
+              str(len(json_body)).encode('ascii'), b'\r\n\r\n', json_body]
+
+    for part in parts:
+        if not isinstance(part, memoryview):
+            part = memoryview(part)
+
+        if part.ndim != 1 or part.itemsize != 1:
+            # Only a flat view of bytes has the right length
+            try:
+                part = part.cast('B')
+
+            except (AttributeError, TypeError):
+                # Python 2 (no cast()) or non-contiguous view: copy it
+                part = memoryview(part.tobytes())
+
+        chunks.extend((b'\r\n', delimiter,
+                       b'\r\nContent-Type: application/octet-stream'
+                       b'\r\nContent-Length: ',
+                       str(len(part)).encode('ascii'), b'\r\n\r\n', part))
+
+    chunks.extend((b'\r\n', delimiter, b'--\r\n'))
+
+    content_type = '{0}; boundary={1}'.format(MULTIPART_MIXED,
+                                              boundary.decode('ascii'))
+    return content_type, chunks, sum(len(chunk) for chunk in chunks)
+
+
+def get_boundary(content_type):
+    """
+    Returns the boundary of a multipart content type
+
+    :param content_type: Value of a Content-Type header
+    :return: The boundary (bytes), or None if it's not a multipart content
+    """
+    if not content_type or not content_type.startswith(MULTIPART_MIXED):
+        return None
+
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key == 'boundary':
+            return value.strip('"').encode('ascii')
+
+    return None
+
+
+def parse_multipart(data, boundary):
+    """
+    Splits a multipart body, as prepared by make_multipart().
+    Sections are read according to their Content-Length header, so that binary
+    contents are never scanned.
+
+    :param data: The complete body (bytes)
+    :param boundary: The multipart boundary (bytes)
+    :return: A (JSON body, binary parts) tuple, as memoryview objects over data
+    :raise ValueError: Invalid multipart body
+    """
+    view = memoryview(data)
+    delimiter = b'--' + boundary
+    sections = []
+
+    pos = data.find(delimiter)
+    while pos != -1:
+        pos += len(delimiter)
+        if data[pos:pos + 2] == b'--':
+            # Closing delimiter
+            break
+
+        # Read section headers
+        headers_end = data.find(b'\r\n\r\n', pos)
+        if headers_end == -1:
+            raise ValueError("Truncated multipart section")
+
+        length = None
+        for line in data[pos:headers_end].split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                length = int(value)
+
+        if length is None:
+            raise ValueError("Multipart section without Content-Length")
+
+        # Keep a view on the content
+        start = headers_end + 4
+        sections.append(view[start:start + length])
+
+        # Next delimiter (right after the content and its CRLF)
+        pos = data.find(delimiter, start + length)
+
+    if not sections:
+        raise ValueError("Empty multipart body")
+
+    return sections[0], sections[1:]
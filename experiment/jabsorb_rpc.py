@@ -42,6 +42,7 @@ import jsonrpclib.jsonrpc as jsonrpclib
 
 # Cohorte
 import experiment.jabsorb as jabsorb
+import experiment.rpc_metrics as rpc_metrics
 
 # iPOPO Decorators
 from pelix.ipopo.decorators import ComponentFactory, Provides, Validate, \
@@ -53,11 +54,23 @@ from pelix.remote import RemoteServiceError
 from pelix.utilities import to_str
 
 # Standard library
+import errno
 import logging
 import socket
 import threading
+import time
 import uuid
 
+try:
+    # Python 3
+    from urllib.parse import urlparse
+    import http.client as httplib
+
+except ImportError:
+    # Python 2
+    from urlparse import urlparse
+    import httplib
+
 # ------------------------------------------------------------------------------
 
 JABSORB_CONFIG = 'ecf.jabsorb'
@@ -72,6 +85,55 @@ PROP_HTTP_ACCESSES = '{0}.accesses'.format(JABSORB_CONFIG)
 HOST_SERVLET_PATH = "/JABSORB-RPC"
 """ Default servlet path """
 
+PROP_LOAD_BALANCING = '{0}.balancing'.format(JABSORB_CONFIG)
+"""
+Importer property: name of the load balancing policy used to group the
+endpoints exporting the same specifications behind a single service, or None to
+import each endpoint as a service
+"""
+
+BALANCING_ROUND_ROBIN = 'round-robin'
+""" Load balancing: each replica in turn """
+
+BALANCING_LEAST_OUTSTANDING = 'least-outstanding'
+""" Load balancing: replica with the least pending calls """
+
+BALANCING_LATENCY = 'latency'
+""" Load balancing: replica with the lowest average call duration """
+
+EJECTION_THRESHOLD = 3
+""" Number of consecutive transport errors before ejecting a replica """
+
+EJECTION_DELAY = 30
+""" Time during which an ejected replica isn't used (s) """
+
+LATENCY_EWMA_WEIGHT = 0.3
+""" Weight of the last call duration in the latency average of a replica """
+
+PROBE_INTERVAL = 10
+""" Delay between two probes of the HTTP accesses of imported endpoints (s) """
+
+PROBE_TIMEOUT = 2
+""" Maximum time to connect an HTTP access while probing it (s) """
+
+PROP_CALL_TIMEOUT = '{0}.timeout'.format(JABSORB_CONFIG)
+""" Importer property: socket timeout of the remote calls (s) """
+
+CALL_TIMEOUT = 60
+""" Default socket timeout of the remote calls (s) """
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+""" Default port of the access URL schemes """
+
+CONNECTION_ERRORS = frozenset(getattr(errno, name) for name in
+                              ('ECONNREFUSED', 'EHOSTUNREACH', 'ENETUNREACH',
+                               'EHOSTDOWN', 'ENETDOWN', 'EADDRNOTAVAIL')
+                              if hasattr(errno, name))
+"""
+Socket errors raised before a request could be sent: the call can be retried
+on another access without breaking the "exactlyOnce" intent
+"""
+
 _logger = logging.getLogger(__name__)
 
 # ------------------------------------------------------------------------------
@@ -81,9 +143,14 @@ class _JabsorbRpcServlet(SimpleJSONRPCDispatcher):
     A JSON-RPC servlet, replacing the SimpleJSONRPCDispatcher from jsonrpclib,
     converting data from and to Jabsorb format.
     """
-    def __init__(self, dispatch_method, encoding=None):
+    def __init__(self, dispatch_method, encoding=None, get_metrics=None):
         """
         Sets up the servlet
+
+        :param dispatch_method: Method to call to dispatch a request
+        :param encoding: Requests encoding
+        :param get_metrics: Method returning the call metrics service to use,
+                            or None if calls must not be measured
         """
         SimpleJSONRPCDispatcher.__init__(self, encoding)
 
@@ -93,6 +160,9 @@ class _JabsorbRpcServlet(SimpleJSONRPCDispatcher):
         # Make a link to the dispatch method
         self._dispatch_method = dispatch_method
 
+        # Call metrics
+        self._get_metrics = get_metrics
+
 
     def _simple_dispatch(self, name, params):
         """
@@ -111,6 +181,46 @@ class _JabsorbRpcServlet(SimpleJSONRPCDispatcher):
         return self._dispatch_method(name, params)
 
 
+    def _record_call(self, metrics, data, error, size_in, size_out, start):
+        """
+        Records a call in the metrics service
+
+        :param metrics: The call metrics service
+        :param data: The parsed request
+        :param error: True if the call failed
+        :param size_in: Size of the request body
+        :param size_out: Size of the response body
+        :param start: Time when the request started to be handled
+        """
+        duration = rpc_metrics.timer() - start
+
+        if isinstance(data, dict):
+            # Method name is "endpoint_name.method_name"
+            endpoint, _, method = str(data.get('method')).rpartition('.')
+
+        else:
+            # Batch call
+            endpoint, method = '', 'system.multicall'
+
+        metrics.record(rpc_metrics.SIDE_EXPORT, endpoint, method, duration,
+                       error, size_in, size_out)
+
+
+    @staticmethod
+    def _convert_params(data):
+        """
+        Converts the parameters of the given request from Jabsorb, in place.
+        Only the parameters are converted: the rest of the request envelope
+        only holds scalars.
+
+        :param data: The parsed request (a call or a list of calls)
+        """
+        calls = data if isinstance(data, list) else (data,)
+        for call in calls:
+            if isinstance(call, dict) and 'params' in call:
+                call['params'] = jabsorb.from_jabsorb(call['params'])
+
+
     def do_POST(self, request, response):
         """
         Handle a post request
@@ -118,11 +228,54 @@ class _JabsorbRpcServlet(SimpleJSONRPCDispatcher):
         :param request: The HTTP request bean
         :param request: The HTTP response handler
         """
-        # Get the request JSON content
-        data = jsonrpclib.loads(to_str(request.read_data()))
+        # Check if the call must be measured
+        metrics = self._get_metrics() if self._get_metrics is not None else None
+        if metrics is not None:
+            start = rpc_metrics.timer()
+
+        # Get the request content
+        raw_data = request.read_data()
+        boundary = jabsorb.get_boundary(request.get_header('Content-Type'))
+        data = None
+        fault = None
+        try:
+            if boundary is None:
+                # Plain JSON
+                data = jsonrpclib.loads(to_str(raw_data))
+                parts = None
 
-        # Convert from Jabsorb
-        data = jabsorb.from_jabsorb(data)
+            else:
+                # JSON followed by binary sections: keep views over the
+                # request
+                json_body, parts = jabsorb.parse_multipart(raw_data,
+                                                           boundary)
+                data = jsonrpclib.loads(to_str(json_body.tobytes()))
+
+        except ValueError as ex:
+            fault = jsonrpclib.Fault(-32700,
+                                     "Invalid request: {0}".format(ex))
+
+        else:
+            # Convert from Jabsorb
+            self._convert_params(data)
+            if parts and isinstance(data, dict):
+                try:
+                    data['params'] = jabsorb.inject_binaries(
+                                                data.get('params'), parts)
+
+                except ValueError as ex:
+                    fault = jsonrpclib.Fault(-32602,
+                                             "Invalid params: {0}".format(ex),
+                                             rpcid=data.get('id'))
+
+        if fault is not None:
+            # Reply with a JSON-RPC error, not an HTTP one
+            result = fault.response()
+            response.send_content(200, result, 'application/json-rpc')
+            if metrics is not None:
+                self._record_call(metrics, data, True, len(raw_data),
+                                  len(result), start)
+            return
 
         # Dispatch
         try:
@@ -132,20 +285,50 @@ class _JabsorbRpcServlet(SimpleJSONRPCDispatcher):
             # No result (never happens, but who knows...)
             result = None
 
+        error = False
+        chunks = None
         if result is not None:
             # Convert result to Jabsorb
             if 'result' in result:
                 result['result'] = jabsorb.to_jabsorb(result['result'])
 
-            # Store JSON
-            result = jsonrpclib.jdumps(result)
+                if boundary is not None \
+                        and jabsorb.has_binaries(result['result']):
+                    # The caller handles multipart: send binaries as is
+                    parts = []
+                    result['result'] = jabsorb.extract_binaries(
+                                                    result['result'], parts)
+                    content_type, chunks, size_out = jabsorb.make_multipart(
+                            jsonrpclib.jdumps(result).encode('UTF-8'), parts)
+
+            else:
+                error = 'error' in result
+
+            if chunks is None:
+                # Store JSON
+                result = jsonrpclib.jdumps(result)
 
         else:
             # It was a notification
             result = ''
 
         # Send the result
-        response.send_content(200, result, 'application/json-rpc')
+        if chunks is None:
+            response.send_content(200, result, 'application/json-rpc')
+            size_out = len(result)
+
+        else:
+            # Write the sections one by one, to avoid copying binaries
+            response.set_response(200)
+            response.set_header('Content-Type', content_type)
+            response.set_header('Content-Length', size_out)
+            response.end_headers()
+            for chunk in chunks:
+                response.write(chunk)
+
+        if metrics is not None:
+            self._record_call(metrics, data, error, len(raw_data), size_out,
+                              start)
 
 # ------------------------------------------------------------------------------
 
@@ -153,6 +336,7 @@ class _JabsorbRpcServlet(SimpleJSONRPCDispatcher):
 @Provides(pelix.remote.SERVICE_EXPORT_PROVIDER)
 @Requires('_dispatcher', pelix.remote.SERVICE_DISPATCHER)
 @Requires('_http', pelix.http.HTTP_SERVICE)
+@Requires('_metrics', rpc_metrics.SERVICE_RPC_METRICS, optional=True)
 @Property('_path', pelix.http.HTTP_SERVLET_PATH, HOST_SERVLET_PATH)
 @Property('_kinds', pelix.remote.PROP_REMOTE_CONFIGS_SUPPORTED,
           (JABSORB_CONFIG,))
@@ -180,6 +364,9 @@ class JabsorbRpcServiceExporter(object):
         # JSON-RPC servlet
         self._servlet = None
 
+        # Call metrics (optional)
+        self._metrics = None
+
         # Exported services: Name -> ExportEndpoint
         self.__endpoints = {}
 
@@ -187,6 +374,17 @@ class JabsorbRpcServiceExporter(object):
         self.__lock = threading.Lock()
 
 
+    def _get_metrics(self):
+        """
+        Returns the call metrics service if calls must be measured, else None
+        """
+        metrics = self._metrics
+        if metrics is not None and metrics.enabled:
+            return metrics
+
+        return None
+
+
     def _dispatch(self, method, params):
         """
         Called by the JSON-RPC servlet: calls the method of an exported service
@@ -355,7 +553,8 @@ class JabsorbRpcServiceExporter(object):
         self._context = context
 
         # Create/register the servlet
-        self._servlet = _JabsorbRpcServlet(self._dispatch)
+        self._servlet = _JabsorbRpcServlet(self._dispatch,
+                                           get_metrics=self._get_metrics)
         self._http.register_servlet(self._path, self._servlet)
 
 
@@ -376,58 +575,525 @@ class JabsorbRpcServiceExporter(object):
 
 # ------------------------------------------------------------------------------
 
+class _Access(object):
+    """
+    State of an HTTP access of an imported endpoint
+    """
+    __slots__ = ('url', 'address', 'healthy', 'latency')
+
+    def __init__(self, url):
+        """
+        Sets up members
+
+        :param url: Access URL
+        """
+        self.url = url
+        self.healthy = True
+
+        # Probed connection time, None until probed
+        self.latency = None
+
+        # Address to probe
+        parsed = urlparse(url)
+        self.address = (parsed.hostname,
+                        parsed.port or _DEFAULT_PORTS.get(parsed.scheme, 80))
+
+
+class _AccessSelector(object):
+    """
+    Keeps track of all the HTTP accesses of an imported endpoint, and orders
+    them by health and latency
+    """
+    def __init__(self, urls):
+        """
+        Sets up members
+
+        :param urls: List of access URLs
+        """
+        self.__lock = threading.Lock()
+        self.__accesses = [_Access(url) for url in urls]
+        self.__ordered = self.__accesses[:]
+
+
+    @staticmethod
+    def parse(accesses):
+        """
+        Splits the given comma-separated accesses string
+
+        :param accesses: Value of the PROP_HTTP_ACCESSES property
+        :return: The list of URLs
+        """
+        return [url.strip() for url in accesses.split(',') if url.strip()]
+
+
+    def __sort(self):
+        """
+        Updates the ordered list of accesses: healthy ones first, then
+        by latency. Unprobed accesses keep their advertised order, after probed
+        ones. Must be called while holding the lock.
+        """
+        def sort_key(indexed):
+            idx, access = indexed
+            return (not access.healthy,
+                    access.latency is None,
+                    access.latency or 0,
+                    idx)
+
+        self.__ordered = [access for _, access in
+                          sorted(enumerate(self.__accesses), key=sort_key)]
+
+
+    def get_urls(self):
+        """
+        Returns the access URLs, best one first
+        """
+        return [access.url for access in self.__ordered]
+
+
+    def has_healthy(self):
+        """
+        Checks if at least one access is considered healthy
+        """
+        return any(access.healthy for access in self.__ordered)
+
+
+    def set_urls(self, urls):
+        """
+        Updates the list of accesses, keeping the state of the known ones
+
+        :param urls: New list of access URLs
+        """
+        with self.__lock:
+            known = dict((access.url, access) for access in self.__accesses)
+            self.__accesses = [known.get(url) or _Access(url) for url in urls]
+            self.__sort()
+
+
+    def report_failure(self, url):
+        """
+        Marks the given access as unhealthy
+
+        :param url: The access URL
+        """
+        with self.__lock:
+            for access in self.__accesses:
+                if access.url == url:
+                    access.healthy = False
+                    break
+
+            self.__sort()
+
+
+    def probe(self, timeout=PROBE_TIMEOUT):
+        """
+        Measures the time needed to open a TCP connection to each access
+
+        :param timeout: Maximum time to wait for each connection
+        """
+        results = []
+        for access in self.__accesses[:]:
+            start = rpc_metrics.timer()
+            try:
+                sock = socket.create_connection(access.address, timeout)
+
+            except (socket.error, socket.timeout) as ex:
+                _logger.debug("Access %s unreachable: %s", access.url, ex)
+                results.append((access, None))
+
+            else:
+                results.append((access, rpc_metrics.timer() - start))
+                sock.close()
+
+        with self.__lock:
+            for access, latency in results:
+                access.healthy = latency is not None
+                if latency is not None:
+                    access.latency = latency
+
+            self.__sort()
+
+
+def _call_http(url, method_name, params, parts=None, timeout=CALL_TIMEOUT):
+    """
+    Calls a method through HTTP. Binary arguments, if any, are sent as
+    sections following the JSON-RPC request, without being converted nor
+    copied
+
+    :param url: Access URL
+    :param method_name: Full name of the method to call
+    :param params: Method parameters in Jabsorb format, with placeholders for
+                   the binary arguments
+    :param parts: Binary arguments, or None
+    :param timeout: Socket timeout (s)
+    :return: A (raw method result, request size, response size) tuple
+    :raise socket.error: Error accessing the URL
+    :raise ProtocolError: Error returned by the exporter
+    """
+    parsed = urlparse(url)
+    request = jsonrpclib.dumps(params, method_name,
+                               rpcid=str(uuid.uuid4())).encode('UTF-8')
+    if parts:
+        content_type, chunks, length = jabsorb.make_multipart(request, parts)
+
+    else:
+        # Plain JSON-RPC
+        content_type, chunks, length = 'application/json-rpc', (request,), \
+            len(request)
+
+    if parsed.scheme == 'https':
+        connection = httplib.HTTPSConnection(parsed.hostname, parsed.port,
+                                             timeout=timeout)
+
+    else:
+        connection = httplib.HTTPConnection(parsed.hostname, parsed.port,
+                                            timeout=timeout)
+
+    try:
+        connection.putrequest('POST', parsed.path or '/')
+        connection.putheader('Content-Type', content_type)
+        connection.putheader('Content-Length', str(length))
+        connection.endheaders()
+        for chunk in chunks:
+            connection.send(chunk)
+
+        response = connection.getresponse()
+        raw_data = response.read()
+        if response.status != 200:
+            raise jsonrpclib.ProtocolError((response.status, response.reason))
+
+        boundary = jabsorb.get_boundary(response.getheader('Content-Type'))
+
+    finally:
+        connection.close()
+
+    if boundary is None:
+        result = jsonrpclib.loads(to_str(raw_data))
+        binaries = None
+
+    else:
+        # Binary values in the result
+        json_body, binaries = jabsorb.parse_multipart(raw_data, boundary)
+        result = jsonrpclib.loads(to_str(json_body.tobytes()))
+
+    jsonrpclib.check_for_errors(result)
+    result = result.get('result')
+    if binaries:
+        result = jabsorb.inject_binaries(result, binaries)
+
+    return result, length, len(raw_data)
+
+
 class _ServiceCallProxy(object):
     """
     Service call proxy
     """
-    def __init__(self, uid, name, url, on_error):
+    def __init__(self, uid, name, selector, on_error, get_metrics=None,
+                 timeout=CALL_TIMEOUT):
         """
         Sets up the call proxy
 
         :param uid: End point UID
         :param name: End point name
-        :param url: End point URL
-        :param on_error: A method to call back in case of socket error
+        :param selector: The _AccessSelector of the end point
+        :param on_error: A method to call back when all accesses failed
+        :param get_metrics: Method returning the call metrics service to use,
+                            or None if calls must not be measured
+        :param timeout: Socket timeout of the calls (s)
         """
         self.__uid = uid
         self.__name = name
-        self.__url = url
+        self.__selector = selector
         self.__on_error = on_error
+        self.__get_metrics = get_metrics
+        self.__timeout = timeout
+
+
+    def __call(self, method_name, args, kwargs):
+        """
+        Calls the given method on the best access, and fails over to the next
+        ones if the connection can't be established
+
+        :param method_name: Full name of the method to call
+        :param args: Method arguments, in Jabsorb format
+        :param kwargs: Method keyword arguments, in Jabsorb format
+        :return: A (raw method result, request size, response size) tuple
+        :raise socket.error: All accesses failed
+        """
+        parts = None
+        params = kwargs or args
+        if jabsorb.has_binaries(params):
+            # Send binary arguments in their own sections
+            parts = []
+            params = jabsorb.extract_binaries(params, parts)
+
+        error = None
+        for url in self.__selector.get_urls():
+            try:
+                # A new connection for each call, to handle multithreaded
+                # calls
+                return _call_http(url, method_name, params, parts,
+                                  self.__timeout)
+
+            except socket.error as ex:
+                self.__selector.report_failure(url)
+                if getattr(ex, 'errno', None) not in CONNECTION_ERRORS:
+                    # The request might have been sent: don't retry it
+                    error = ex
+                    break
+
+                _logger.debug("Access %s failed, trying the next one: %s",
+                              url, ex)
+                error = ex
+
+        if not self.__selector.has_healthy() and self.__on_error is not None:
+            # In case of transport error, look if the service has gone away
+            self.__on_error(self.__uid)
+
+        # Let the exception stop the caller
+        raise error or socket.error("No access to {0}".format(self.__name))
 
 
     def __getattr__(self, name):
         """
         Prefixes the requested attribute name by the endpoint name
         """
-        # Make a proxy for this call
-        # This is an ugly trick to handle multithreaded calls, as the underlying
-        # proxy re-uses the same connection when possible: sometimes it means
-        # sending a request before retrieving a result
-        proxy = jsonrpclib.ServerProxy(self.__url)
+        method_name = "{0}.{1}".format(self.__name, name)
 
         def wrapped_call(*args, **kwargs):
             """
             Wrapped call
             """
-            # Get the method from the proxy
-            method = getattr(proxy, "{0}.{1}".format(self.__name, name))
-
             # Convert arguments
             args = [jabsorb.to_jabsorb(arg) for arg in args]
             kwargs = dict([(key, jabsorb.to_jabsorb(value))
                                for key, value in kwargs.items()])
 
+            metrics = self.__get_metrics() \
+                                if self.__get_metrics is not None else None
+            if metrics is not None:
+                start = rpc_metrics.timer()
+                error = True
+
+            size_in = size_out = 0
             try:
-                result = method(*args, **kwargs)
-                return jabsorb.from_jabsorb(result)
+                result, size_out, size_in = self.__call(method_name, args,
+                                                        kwargs)
+                result = jabsorb.from_jabsorb(result)
+                error = False
+                return result
+
+            finally:
+                if metrics is not None:
+                    metrics.record(rpc_metrics.SIDE_IMPORT, self.__name, name,
+                                   rpc_metrics.timer() - start, error,
+                                   size_in, size_out)
 
-            except socket.error:
-                # In case of transport error, look if the service has gone away
-                if self.__on_error is not None:
-                    self.__on_error(self.__uid)
+        return wrapped_call
 
-                # Let the exception stop the caller
-                raise
+# ------------------------------------------------------------------------------
+
+class _Replica(object):
+    """
+    State of a member of a replica group
+    """
+    __slots__ = ('uid', 'proxy', 'outstanding', 'latency', 'failures',
+                 'ejected_until')
+
+    def __init__(self, uid, proxy):
+        """
+        Sets up members
+
+        :param uid: End point UID
+        :param proxy: The _ServiceCallProxy of the end point
+        """
+        self.uid = uid
+        self.proxy = proxy
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.ejected_until = 0
+
+
+class _ReplicaGroup(object):
+    """
+    Aggregating proxy: spreads the calls across the imported end points
+    exporting the same specifications
+    """
+    def __init__(self, policy):
+        """
+        Sets up the group
+
+        :param policy: Name of the load balancing policy
+        :raise ValueError: Unknown policy
+        """
+        try:
+            self.__choose = {
+                    BALANCING_ROUND_ROBIN: self.__choose_round_robin,
+                    BALANCING_LEAST_OUTSTANDING: self.__choose_outstanding,
+                    BALANCING_LATENCY: self.__choose_latency}[policy]
+
+        except KeyError:
+            raise ValueError("Unknown load balancing policy: {0}"
+                             .format(policy))
+
+        self.__replicas = []
+        self.__lock = threading.Lock()
+
+        # Rotation counter
+        self.__next = 0
+
+        # Service registration of the group
+        self.registration = None
+
+
+    @staticmethod
+    def __choose_round_robin(candidates):
+        """
+        Round-robin: the rotated list of candidates gives the next one
+        """
+        return candidates[0]
+
+
+    @staticmethod
+    def __choose_outstanding(candidates):
+        """
+        Replica with the least calls in progress
+        """
+        return min(candidates, key=lambda replica: replica.outstanding)
+
+
+    @staticmethod
+    def __choose_latency(candidates):
+        """
+        Replica with the lowest average call duration (unmeasured ones first)
+        """
+        return min(candidates, key=lambda replica: replica.latency or 0.0)
+
+
+    def add(self, uid, proxy):
+        """
+        Adds a member to the group
+
+        :param uid: End point UID
+        :param proxy: The _ServiceCallProxy of the end point
+        """
+        with self.__lock:
+            self.__replicas.append(_Replica(uid, proxy))
+
+
+    def remove(self, uid):
+        """
+        Removes a member from the group
+
+        :param uid: End point UID
+        :return: True if the group is now empty
+        """
+        with self.__lock:
+            self.__replicas = [replica for replica in self.__replicas
+                               if replica.uid != uid]
+            return not self.__replicas
+
+
+    def get_uids(self):
+        """
+        Returns the UIDs of the members of the group, oldest first
+        """
+        return [replica.uid for replica in self.__replicas]
+
+
+    def __acquire(self, excluded):
+        """
+        Selects the replica to call
+
+        :param excluded: Replicas which already failed for this call
+        :return: A _Replica bean, or None
+        """
+        now = time.time()
+        with self.__lock:
+            candidates = [replica for replica in self.__replicas
+                          if replica not in excluded]
+            if not candidates:
+                return None
+
+            # Ignore ejected replicas, unless they are the only ones left
+            active = [replica for replica in candidates
+                      if replica.ejected_until <= now]
+            if active:
+                candidates = active
+
+            # Rotate candidates to spread ties
+            offset = self.__next % len(candidates)
+            self.__next += 1
+            replica = self.__choose(candidates[offset:] + candidates[:offset])
+            replica.outstanding += 1
+            return replica
+
+
+    def __release(self, replica, duration=None, error=None):
+        """
+        Updates the state of a replica after a call
+
+        :param replica: The called replica
+        :param duration: Duration of a successful call
+        :param error: Transport error raised by a failed call
+        """
+        with self.__lock:
+            replica.outstanding -= 1
+
+            if error is None:
+                replica.failures = 0
+                if duration is not None:
+                    if replica.latency is None:
+                        replica.latency = duration
+                    else:
+                        replica.latency += LATENCY_EWMA_WEIGHT \
+                                                * (duration - replica.latency)
+                return
+
+            replica.failures += 1
+            if replica.failures >= EJECTION_THRESHOLD \
+                    or getattr(error, 'errno', None) in CONNECTION_ERRORS:
+                _logger.debug("Ejecting replica %s: %s", replica.uid, error)
+                replica.failures = 0
+                replica.ejected_until = time.time() + EJECTION_DELAY
+
+
+    def __getattr__(self, name):
+        """
+        Returns a method calling the given one on the chosen replica
+        """
+        def wrapped_call(*args, **kwargs):
+            """
+            Wrapped call
+            """
+            tried = []
+            error = None
+            while True:
+                replica = self.__acquire(tried)
+                if replica is None:
+                    raise error or socket.error("No replica available")
+
+                tried.append(replica)
+                start = rpc_metrics.timer()
+                try:
+                    result = getattr(replica.proxy, name)(*args, **kwargs)
+
+                except socket.error as ex:
+                    self.__release(replica, error=ex)
+                    if getattr(ex, 'errno', None) not in CONNECTION_ERRORS:
+                        # The request might have been sent: don't retry it
+                        raise
+
+                    error = ex
+
+                except:
+                    # Error raised by the remote service itself
+                    self.__release(replica)
+                    raise
+
+                else:
+                    self.__release(replica, rpc_metrics.timer() - start)
+                    return result
 
         return wrapped_call
 
@@ -436,9 +1102,12 @@ class _ServiceCallProxy(object):
 @ComponentFactory("cohorte-jabsorbrpc-importer-factory")
 @Provides(pelix.remote.SERVICE_ENDPOINT_LISTENER)
 @Provides(pelix.remote.SERVICE_ENDPOINT_LISTENER)
+@Requires('_metrics', rpc_metrics.SERVICE_RPC_METRICS, optional=True)
 @Property('_kinds', pelix.remote.PROP_REMOTE_CONFIGS_SUPPORTED,
           (JABSORB_CONFIG,))
 @Property('_listener_flag', pelix.remote.PROP_LISTEN_IMPORTED, True)
+@Property('_balancing', PROP_LOAD_BALANCING, None)
+@Property('_timeout', PROP_CALL_TIMEOUT, CALL_TIMEOUT)
 class JabsorbRpcServiceImporter(object):
     """
     JABSORB-RPC Remote Services importer
@@ -453,11 +1122,33 @@ class JabsorbRpcServiceImporter(object):
         # Component properties
         self._kinds = None
         self._listener_flag = True
+        self._balancing = None
+        self._timeout = CALL_TIMEOUT
+
+        # Call metrics (optional)
+        self._metrics = None
 
         # Registered services (end point -> reference)
         self.__registrations = {}
         self.__reg_lock = threading.Lock()
 
+        # Load balancing: Specifications -> _ReplicaGroup
+        self.__groups = {}
+
+        # Load balancing: end point -> Specifications
+        self.__members = {}
+
+        # Load balancing: end point -> Properties
+        self.__members_props = {}
+
+        # HTTP accesses of end points (end point -> _AccessSelector)
+        self.__selectors = {}
+
+        # Accesses probe thread
+        self.__probe_event = threading.Event()
+        self.__probe_thread = None
+        self.__stopped = True
+
 
     def endpoint_added(self, endpoint):
         """
@@ -468,22 +1159,20 @@ class JabsorbRpcServiceImporter(object):
             # Not for us
             return
 
-        # Get the access URL
-        access_url = endpoint.properties.get(PROP_HTTP_ACCESSES)
-        if not access_url:
+        # Get the access URLs
+        access_urls = _AccessSelector.parse(
+                            endpoint.properties.get(PROP_HTTP_ACCESSES) or '')
+        if not access_urls:
             # No URL information
             _logger.warning("No access URL given: %s", endpoint)
             return
 
-        else:
-            # Get the first URL in the list
-            access_url = access_url.split(',')[0]
-
-        _logger.debug("Chosen access: %s", access_url)
+        _logger.debug("Available accesses: %s", access_urls)
 
         with self.__reg_lock:
             # Already known end point
-            if endpoint.uid in self.__registrations:
+            if endpoint.uid in self.__registrations \
+                    or endpoint.uid in self.__members:
                 return
 
             # Compute the name
@@ -494,14 +1183,34 @@ class JabsorbRpcServiceImporter(object):
 
             _logger.debug("Importing %s with name = %s", endpoint, name)
 
-            # Register the service
-            svc = _ServiceCallProxy(endpoint.uid, name, access_url,
-                                    self._unregister)
-            svc_reg = self._context.register_service(endpoint.specifications,
-                                                     svc, endpoint.properties)
+            # Prepare the proxy: replicas are ejected by their group, only
+            # standalone proxies unregister themselves once unreachable
+            if self._balancing:
+                on_error = None
+            else:
+                on_error = self.__unreachable
+
+            selector = _AccessSelector(access_urls)
+            svc = _ServiceCallProxy(endpoint.uid, name, selector,
+                                    on_error, self._get_metrics,
+                                    self._timeout)
+
+            if self._balancing:
+                # Add the proxy to its replica group
+                self.__add_member(endpoint, svc)
+
+            else:
+                # Register the service
+                svc_reg = self._context.register_service(
+                            endpoint.specifications, svc, endpoint.properties)
+                self.__registrations[endpoint.uid] = svc_reg
 
             # Store references
-            self.__registrations[endpoint.uid] = svc_reg
+            self.__selectors[endpoint.uid] = selector
+
+        if len(access_urls) > 1:
+            # Order the accesses as soon as possible
+            self.__probe_event.set()
 
 
     def endpoint_updated(self, endpoint, old_properties):
@@ -509,13 +1218,30 @@ class JabsorbRpcServiceImporter(object):
         An end point has been updated
         """
         with self.__reg_lock:
-            if endpoint.uid not in self.__registrations:
+            if endpoint.uid in self.__registrations:
+                # Update service properties
+                svc_reg = self.__registrations[endpoint.uid]
+                svc_reg.set_properties(endpoint.properties)
+
+            elif endpoint.uid in self.__members:
+                # The group service has the properties of its oldest member
+                self.__members_props[endpoint.uid] = endpoint.properties
+                group = self.__groups[self.__members[endpoint.uid]]
+                if group.get_uids()[0] == endpoint.uid:
+                    group.registration.set_properties(endpoint.properties)
+
+            else:
                 # Unknown end point
                 return
 
-            # Update service properties
-            svc_reg = self.__registrations[endpoint.uid]
-            svc_reg.set_properties(endpoint.properties)
+            # Update accesses
+            access_urls = _AccessSelector.parse(
+                            endpoint.properties.get(PROP_HTTP_ACCESSES) or '')
+            if access_urls:
+                self.__selectors[endpoint.uid].set_urls(access_urls)
+
+        if len(access_urls) > 1:
+            self.__probe_event.set()
 
 
     def endpoint_removed(self, endpoint):
@@ -523,11 +1249,94 @@ class JabsorbRpcServiceImporter(object):
         An end point has been removed
         """
         with self.__reg_lock:
-            if endpoint.uid in self.__registrations:
+            if endpoint.uid in self.__registrations \
+                    or endpoint.uid in self.__members:
                 # Unregister the end point
                 self._unregister(endpoint.uid)
 
 
+    def __unreachable(self, endpoint_uid):
+        """
+        Called by a proxy when none of its accesses can be reached
+
+        :param endpoint_uid: UID of the unreachable end point
+        """
+        with self.__reg_lock:
+            if endpoint_uid in self.__registrations:
+                self._unregister(endpoint_uid)
+
+
+    def _get_metrics(self):
+        """
+        Returns the call metrics service if calls must be measured, else None
+        """
+        metrics = self._metrics
+        if metrics is not None and metrics.enabled:
+            return metrics
+
+        return None
+
+
+    def __add_member(self, endpoint, svc):
+        """
+        Adds an imported end point to the replica group of its specifications,
+        and registers the group service if necessary
+
+        :param endpoint: An ImportEndpoint bean
+        :param svc: The _ServiceCallProxy of the end point
+        """
+        key = frozenset(endpoint.specifications)
+        group = self.__groups.get(key)
+        if group is None:
+            # First replica: register the group
+            group = _ReplicaGroup(self._balancing)
+            group.add(endpoint.uid, svc)
+            group.registration = self._context.register_service(
+                                endpoint.specifications, group,
+                                endpoint.properties)
+            self.__groups[key] = group
+
+        else:
+            group.add(endpoint.uid, svc)
+
+        self.__members[endpoint.uid] = key
+        self.__members_props[endpoint.uid] = endpoint.properties
+
+
+    def __remove_member(self, endpoint_uid):
+        """
+        Removes an end point from its replica group, and unregisters the group
+        service if it was the last member. If it was the oldest member, the
+        group service takes the properties of the new oldest one.
+
+        :param endpoint_uid: An end point UID
+        :return: True on success, else False
+        """
+        key = self.__members.pop(endpoint_uid)
+        self.__members_props.pop(endpoint_uid, None)
+        self.__selectors.pop(endpoint_uid, None)
+
+        group = self.__groups[key]
+        was_oldest = group.get_uids()[0] == endpoint_uid
+        if group.remove(endpoint_uid):
+            # No more replica
+            del self.__groups[key]
+            try:
+                group.registration.unregister()
+
+            except pelix.framework.BundleException as ex:
+                _logger.debug("Can't unregister group %s: %s", key, ex)
+                return False
+
+        elif was_oldest:
+            # Don't keep the properties (UID, framework...) of the removed
+            # end point
+            group.registration.set_properties(
+                                self.__members_props[group.get_uids()[0]])
+
+        return True
+
+
     def _unregister(self, endpoint_uid):
         """
         Unregisters the service associated to the given UID
@@ -535,9 +1344,14 @@ class JabsorbRpcServiceImporter(object):
         :param endpoint_uid: An end point UID
         :return: True on success, else False
         """
+        if endpoint_uid in self.__members:
+            # Load balanced end point
+            return self.__remove_member(endpoint_uid)
+
         try:
             # Pop references
             svc_reg = self.__registrations.pop(endpoint_uid)
+            self.__selectors.pop(endpoint_uid, None)
 
             # Unregister the service
             svc_reg.unregister()
@@ -552,6 +1366,26 @@ class JabsorbRpcServiceImporter(object):
             return False
 
 
+    def __probe_loop(self):
+        """
+        Regularly probes the accesses of end points with more than one access
+        """
+        while not self.__stopped:
+            self.__probe_event.wait(PROBE_INTERVAL)
+            self.__probe_event.clear()
+
+            with self.__reg_lock:
+                selectors = [selector
+                             for selector in self.__selectors.values()
+                             if len(selector.get_urls()) > 1]
+
+            for selector in selectors:
+                if self.__stopped:
+                    break
+
+                selector.probe()
+
+
     @Validate
     def validate(self, context):
         """
@@ -559,10 +1393,38 @@ class JabsorbRpcServiceImporter(object):
         """
         self._context = context
 
+        if self._balancing:
+            try:
+                # Check the load balancing policy
+                _ReplicaGroup(self._balancing)
+
+            except ValueError as ex:
+                _logger.error("%s: importing end points without balancing",
+                              ex)
+                self._balancing = None
+
+        # Start the probe thread
+        self.__stopped = False
+        self.__probe_event.clear()
+        self.__probe_thread = threading.Thread(target=self.__probe_loop,
+                                               name="JabsorbRpc-Probe")
+        self.__probe_thread.daemon = True
+        self.__probe_thread.start()
+
 
     @Invalidate
     def invalidate(self, context):
         """
         Component invalidated
         """
+        # Stop the probe thread
+        self.__stopped = True
+        self.__probe_event.set()
+        self.__probe_thread.join(PROBE_TIMEOUT)
+        self.__probe_thread = None
+
+        self.__selectors.clear()
+        self.__groups.clear()
+        self.__members.clear()
+        self.__members_props.clear()
         self._context = None
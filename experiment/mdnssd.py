@@ -54,15 +54,835 @@ from pelix.ipopo.decorators import ComponentFactory, Requires, Provides, \
     Invalidate, Validate, Property
 import pelix.constants
 
+# Local
+import experiment.txt_codec as txt_codec
+
 # Standard library
-import json
 import logging
 import socket
+import threading
+import time
+
+try:
+    # Interfaces enumeration (optional)
+    import netifaces
+
+except ImportError:
+    netifaces = None
 
 # ------------------------------------------------------------------------------
 
 _logger = logging.getLogger(__name__)
 
+RESOLUTION_TIMEOUT = 30000
+""" Time given to a service to answer its information queries (ms) """
+
+QUERY_MAX_DELAY = 5000
+""" Maximum delay between two information queries for a service (ms) """
+
+QUERIES_PER_PACKET = 8
+""" Maximum number of services queried in a single mDNS packet """
+
+REFRESH_PERCENT = 80
+""" Percentage of the TTL of a service record after which it is refreshed """
+
+ANNOUNCE_DELAY = 100
+""" Time given to other registrations to join an announcement (ms) """
+
+ANNOUNCE_ROUNDS = 3
+""" Number of probe packets and of announcement packets (RFC 6762) """
+
+PROP_ENDPOINT_VERSION = "pelix.mdns.version"
+"""
+TXT property: version of the properties of an exported endpoint, incremented
+on each update
+"""
+
+PROP_ACCESS_ADDRESSES = "pelix.access.addresses"
+""" TXT property of the dispatcher servlet: all the addresses of the host """
+
+_PROBE_TARGETS = ((socket.AF_INET, "192.0.2.1"),
+                  (socket.AF_INET6, "2001:db8::1"))
+"""
+Documentation addresses (RFC 5737, RFC 3849) used to find the outgoing address
+of each family, when netifaces is missing
+"""
+
+# ------------------------------------------------------------------------------
+
+def _is_usable(family, address):
+    """
+    Checks if the given address can be reached by other hosts
+
+    :param family: Address family
+    :param address: An address string
+    :return: True if the address can be advertised
+    """
+    if family == socket.AF_INET:
+        return not address.startswith("127.") and address != "0.0.0.0"
+
+    # Link-local addresses would need a scope ID
+    address = address.lower()
+    return address not in ("::", "::1") and not address.startswith("fe80:")
+
+
+def _get_outgoing_address(family, target):
+    """
+    Finds the local address used to reach the given target. Connecting a UDP
+    socket sends no packet and doesn't use the DNS.
+
+    :param family: Address family
+    :param target: Address of a remote host
+    :return: The local address string, or None
+    """
+    sock = None
+    try:
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.connect((target, 9))
+        return sock.getsockname()[0]
+
+    except (socket.error, OSError):
+        # No route for this family
+        return None
+
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def get_host_addresses():
+    """
+    Lists the addresses of the host which can be advertised, without using the
+    DNS. All interfaces are listed if netifaces is available, else only the
+    default outgoing address of each family is found.
+
+    :return: A list of (family, address) tuples, IPv4 addresses first
+    """
+    found = []
+    if netifaces is not None:
+        families = ((socket.AF_INET, netifaces.AF_INET),
+                    (socket.AF_INET6, netifaces.AF_INET6))
+        for interface in netifaces.interfaces():
+            addresses = netifaces.ifaddresses(interface)
+            for family, netifaces_family in families:
+                for entry in addresses.get(netifaces_family, []):
+                    # Remove the scope ID of IPv6 addresses
+                    address = entry.get("addr", "").split("%")[0]
+                    if address:
+                        found.append((family, address))
+
+    else:
+        for family, target in _PROBE_TARGETS:
+            address = _get_outgoing_address(family, target)
+            if address:
+                found.append((family, address))
+
+    result = []
+    for family, address in found:
+        if _is_usable(family, address) and (family, address) not in result:
+            result.append((family, address))
+
+    # Stable sort: IPv4 first
+    result.sort(key=lambda item: item[0] != socket.AF_INET)
+    return result
+
+
+def _common_prefix(packed_a, packed_b):
+    """
+    Computes the number of leading bits shared by two packed addresses
+    """
+    bits = 0
+    for byte_a, byte_b in zip(bytearray(packed_a), bytearray(packed_b)):
+        diff = byte_a ^ byte_b
+        if diff:
+            return bits + 8 - diff.bit_length()
+
+        bits += 8
+
+    return bits
+
+
+def select_address(candidates, local_addresses):
+    """
+    Selects the address of a peer which is the most likely to be reachable
+    directly: an address in the same network as a local one, preferring IPv4
+    then the longest prefix shared with a local address. Else, the first
+    IPv4 candidate is kept.
+
+    :param candidates: Addresses of the peer (strings)
+    :param local_addresses: A list of (family, address) tuples
+    :return: The selected address, or None
+    """
+    best = None
+    best_rank = None
+    for address in candidates:
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        try:
+            packed = socket.inet_pton(family, address)
+
+        except (socket.error, ValueError):
+            # Invalid address
+            continue
+
+        prefix = max([_common_prefix(packed, socket.inet_pton(family, local))
+                      for local_family, local in local_addresses
+                      if local_family == family] or [0])
+
+        # Same network: /24 in IPv4, /64 in IPv6
+        same_network = prefix >= (24 if family == socket.AF_INET else 64)
+        rank = (same_network, family == socket.AF_INET,
+                prefix if same_network else 0)
+        if best_rank is None or rank > best_rank:
+            best = address
+            best_rank = rank
+
+    return best
+
+# ------------------------------------------------------------------------------
+
+class _PendingQuery(object):
+    """
+    Information query for a service
+    """
+    __slots__ = ('info', 'deadline', 'next_query', 'delay')
+
+    def __init__(self, info, now, deadline=None):
+        """
+        Sets up members
+
+        :param info: The ServiceInfo bean to fill
+        :param now: Current time (ms)
+        :param deadline: Time after which the query fails (ms)
+        """
+        self.info = info
+        self.deadline = deadline or now + RESOLUTION_TIMEOUT
+        self.next_query = now
+        self.delay = mdns._LISTENER_TIME
+
+    def is_complete(self):
+        """
+        Checks if all the service information has been received
+        """
+        info = self.info
+        return info.server is not None and info.address is not None \
+            and info.text is not None
+
+
+class _ServiceResolver(object):
+    """
+    Resolves the information of discovered mDNS services in a worker thread.
+
+    Pending queries are sent together, in shared multicast packets, and
+    results are notified as soon as they arrive, instead of resolving each
+    service in turn in the browser thread.
+    """
+    def __init__(self, zeroconf, callback):
+        """
+        Sets up the resolver
+
+        :param zeroconf: The Zeroconf instance
+        :param callback: Method called with (svc_type, name, info) when the
+                         information of a service has been resolved. info is
+                         None on timeout.
+        """
+        self.__zeroconf = zeroconf
+        self.__callback = callback
+
+        # Service name -> _PendingQuery
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+        # Names of the resolved services waiting to be notified, and lock held
+        # while notifying them
+        self.__finished = set()
+        self.__callback_lock = threading.Lock()
+
+        # Scheduled refreshes: Service name -> (time, type, deadline)
+        self.__refreshes = {}
+
+        # New query event
+        self.__event = threading.Event()
+        self.__stopped = False
+        self.__thread = None
+
+
+    def start(self):
+        """
+        Starts the worker thread
+        """
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__loop,
+                                         name="Zeroconf-Resolver")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+
+    def stop(self):
+        """
+        Stops the worker thread and cancels pending queries
+        """
+        self.__stopped = True
+        self.__event.set()
+        self.__thread.join(1)
+        self.__thread = None
+
+        with self.__lock:
+            pending = list(self.__pending.values())
+            self.__pending.clear()
+            self.__refreshes.clear()
+            self.__finished.clear()
+
+        for query in pending:
+            self.__zeroconf.removeListener(query.info)
+
+
+    def resolve(self, svc_type, name, use_cache=True, deadline=None):
+        """
+        Queues the resolution of the given service. Does nothing if the service
+        is already being resolved.
+
+        :param svc_type: Service type
+        :param name: Service name
+        :param use_cache: If False, the records must be received from the
+                          network, even if they are still in cache
+        :param deadline: Time after which the resolution fails (ms)
+        """
+        with self.__lock:
+            if name in self.__pending:
+                # Already queued
+                return
+
+            info = mdns.ServiceInfo(svc_type, name)
+            self.__pending[name] = _PendingQuery(info, mdns.currentTimeMillis(),
+                                                 deadline)
+
+        if use_cache:
+            # Cached records are given to the listener immediately
+            question = mdns.DNSQuestion(name, mdns._TYPE_ANY, mdns._CLASS_IN)
+
+        else:
+            question = None
+
+        self.__zeroconf.addListener(info, question)
+        self.__event.set()
+
+
+    def schedule_refresh(self, svc_type, name, when, deadline):
+        """
+        Schedules a new resolution of the given service from the network, to
+        refresh its records before they expire
+
+        :param svc_type: Service type
+        :param name: Service name
+        :param when: Time of the refresh (ms)
+        :param deadline: Expiration time of the records (ms)
+        """
+        with self.__lock:
+            self.__refreshes[name] = (when, svc_type, deadline)
+
+        self.__event.set()
+
+
+    def __start_refreshes(self, now):
+        """
+        Starts the scheduled refreshes which are due
+
+        :param now: Current time (ms)
+        :return: The time of the next scheduled refresh, or None
+        """
+        due = []
+        next_time = None
+        with self.__lock:
+            for name, (when, svc_type, deadline) \
+                    in list(self.__refreshes.items()):
+                if when <= now:
+                    due.append((svc_type, name, deadline))
+                    del self.__refreshes[name]
+
+                elif next_time is None or when < next_time:
+                    next_time = when
+
+        for svc_type, name, deadline in due:
+            self.resolve(svc_type, name, False, deadline)
+
+        return next_time
+
+
+    def cancel(self, name):
+        """
+        Cancels the resolution of the given service. If its result is being
+        notified, waits for the end of the notification; if it is waiting to
+        be notified, it is dropped.
+
+        :param name: Service name
+        """
+        with self.__callback_lock:
+            with self.__lock:
+                query = self.__pending.pop(name, None)
+                self.__refreshes.pop(name, None)
+                self.__finished.discard(name)
+
+        if query is not None:
+            self.__zeroconf.removeListener(query.info)
+
+
+    def __send_queries(self, queries, now):
+        """
+        Sends the questions for the given services, grouped in packets
+
+        :param queries: A list of _PendingQuery beans
+        :param now: Current time (ms)
+        """
+        zeroconf = self.__zeroconf
+        for idx in range(0, len(queries), QUERIES_PER_PACKET):
+            out = mdns.DNSOutgoing(mdns._FLAGS_QR_QUERY)
+            for query in queries[idx:idx + QUERIES_PER_PACKET]:
+                info = query.info
+
+                # Ask for the missing records, giving the known ones
+                for record_type in (mdns._TYPE_SRV, mdns._TYPE_TXT):
+                    out.addQuestion(mdns.DNSQuestion(info.name, record_type,
+                                                     mdns._CLASS_IN))
+                    out.addAnswerAtTime(zeroconf.cache.getByDetails(
+                            info.name, record_type, mdns._CLASS_IN), now)
+
+                if info.server is not None:
+                    out.addQuestion(mdns.DNSQuestion(info.server,
+                                                     mdns._TYPE_A,
+                                                     mdns._CLASS_IN))
+                    out.addAnswerAtTime(zeroconf.cache.getByDetails(
+                            info.server, mdns._TYPE_A, mdns._CLASS_IN), now)
+
+            zeroconf.send(out)
+
+
+    def __loop(self):
+        """
+        Worker thread loop
+        """
+        while not self.__stopped:
+            now = mdns.currentTimeMillis()
+            next_refresh = self.__start_refreshes(now)
+
+            with self.__lock:
+                has_pending = bool(self.__pending)
+
+            if not has_pending:
+                # Wait for a new query or the next refresh
+                if next_refresh is None:
+                    self.__event.wait()
+
+                else:
+                    self.__event.wait((next_refresh - now) / 1000.0)
+
+                self.__event.clear()
+                continue
+
+            finished = []
+            to_send = []
+            next_time = now + QUERY_MAX_DELAY
+            if next_refresh is not None:
+                next_time = min(next_time, next_refresh)
+
+            with self.__lock:
+                for name, query in list(self.__pending.items()):
+                    if query.is_complete():
+                        finished.append((name, query.info, True))
+                        self.__finished.add(name)
+                        del self.__pending[name]
+
+                    elif query.deadline <= now:
+                        finished.append((name, query.info, False))
+                        self.__finished.add(name)
+                        del self.__pending[name]
+
+                    else:
+                        if query.next_query <= now:
+                            to_send.append(query)
+                            query.next_query = now + query.delay
+                            query.delay = min(query.delay * 2,
+                                              QUERY_MAX_DELAY)
+
+                        next_time = min(next_time, query.next_query,
+                                        query.deadline)
+
+            for name, info, complete in finished:
+                self.__zeroconf.removeListener(info)
+                with self.__callback_lock:
+                    with self.__lock:
+                        if name not in self.__finished:
+                            # Cancelled meanwhile
+                            continue
+
+                        self.__finished.discard(name)
+
+                    try:
+                        self.__callback(info.type, name,
+                                        info if complete else None)
+
+                    except Exception as ex:
+                        _logger.exception("Error handling service %s: %s",
+                                          name, ex)
+
+            if to_send:
+                self.__send_queries(to_send, now)
+
+            if not finished:
+                # Wait for an answer (notified by Zeroconf), the next query or
+                # a new service
+                self.__zeroconf.wait(min(max(next_time - now, 1),
+                                         mdns._LISTENER_TIME))
+
+class _CachedService(object):
+    """
+    Resolved information about a discovered service
+    """
+    __slots__ = ('text', 'properties', 'address', 'port', 'expiration')
+
+    def __init__(self, info, properties, expiration):
+        """
+        Sets up members
+
+        :param info: The resolved ServiceInfo bean
+        :param properties: The deserialized service properties
+        :param expiration: Expiration time of the records (ms)
+        """
+        self.text = info.text
+        self.properties = properties
+        self.address = info.getAddress()
+        self.port = info.getPort()
+        self.expiration = expiration
+
+# ------------------------------------------------------------------------------
+
+def _estimate_size(info, extra_addresses=0):
+    """
+    Computes an upper bound of the size of the records of a service in a
+    packet (PTR, SRV, TXT and address records, without name compression)
+
+    :param info: A ServiceInfo bean
+    :param extra_addresses: Number of additional address records
+    :return: A size in bytes
+    """
+    return len(info.type) * 2 + len(info.name) * 3 \
+        + len(info.server or '') * (2 + extra_addresses) \
+        + len(info.text or '') + 64 + extra_addresses * 32
+
+
+def _split_packets(infos, extra_addresses=0):
+    """
+    Groups services so that the records of each group fit in a packet
+
+    :param infos: A list of ServiceInfo beans
+    :param extra_addresses: Number of additional address records per service
+    :return: A list of lists of ServiceInfo beans
+    """
+    groups = []
+    current = []
+    current_size = 0
+    for info in infos:
+        size = _estimate_size(info, extra_addresses)
+        if current and current_size + size > mdns._MAX_MSG_TYPICAL:
+            groups.append(current)
+            current = []
+            current_size = 0
+
+        current.append(info)
+        current_size += size
+
+    if current:
+        groups.append(current)
+
+    return groups
+
+
+class _ServiceAnnouncer(object):
+    """
+    Registers services in a worker thread.
+
+    Zeroconf.registerService() probes then announces each service in turn,
+    which takes more than a second per service. Here, the services registered
+    within ANNOUNCE_DELAY are probed and announced together, their records
+    being shared in the same packets.
+    """
+    def __init__(self, zeroconf, ttl, extra_addresses=None):
+        """
+        Sets up the announcer
+
+        :param zeroconf: The Zeroconf instance
+        :param ttl: TTL of the announced records (seconds)
+        :param extra_addresses: Address records announced for each service in
+                                addition to its own address, as a list of
+                                (record type, packed address) tuples
+        """
+        self.__zeroconf = zeroconf
+        self.__ttl = ttl
+        self.__extra_addresses = extra_addresses or []
+
+        # ServiceInfo beans waiting to be announced
+        self.__pending = []
+
+        # Names of the services of the current batch, and of those which have
+        # been unregistered while being announced
+        self.__current = set()
+        self.__cancelled = set()
+
+        self.__lock = threading.Lock()
+        self.__event = threading.Event()
+        self.__stopped = False
+        self.__thread = None
+
+
+    def start(self):
+        """
+        Starts the worker thread
+        """
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__loop,
+                                         name="Zeroconf-Announcer")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+
+    def stop(self):
+        """
+        Stops the worker thread. Pending registrations are dropped.
+        """
+        self.__stopped = True
+        self.__event.set()
+        self.__thread.join(2)
+        self.__thread = None
+
+        with self.__lock:
+            del self.__pending[:]
+
+
+    def register(self, infos):
+        """
+        Queues the registration of the given services
+
+        :param infos: A list of ServiceInfo beans
+        """
+        with self.__lock:
+            self.__pending.extend(infos)
+
+        self.__event.set()
+
+
+    def unregister(self, info):
+        """
+        Unregisters the given service, or cancels its registration
+
+        :param info: A ServiceInfo bean
+        """
+        with self.__lock:
+            if info in self.__pending:
+                # Not yet announced
+                self.__pending.remove(info)
+                return
+
+            elif info.name in self.__current:
+                # Being announced: the worker will handle it
+                self.__cancelled.add(info.name)
+                return
+
+        self.__zeroconf.unregisterService(info)
+
+
+    def update_text(self, info, old_text):
+        """
+        Announces the new TXT record of the given service. The previous record
+        is sent with a null TTL, to remove it from the caches of the peers.
+
+        :param info: A ServiceInfo bean, with its new text
+        :param old_text: The previous content of its TXT record
+        """
+        with self.__lock:
+            if info in self.__pending or info.name in self.__current:
+                # Not yet announced: the announcement will use the new text
+                return
+
+        out = mdns.DNSOutgoing(mdns._FLAGS_QR_RESPONSE | mdns._FLAGS_AA)
+        out.addAnswerAtTime(mdns.DNSText(info.name, mdns._TYPE_TXT,
+                                         mdns._CLASS_IN, 0, old_text), 0)
+        out.addAnswerAtTime(mdns.DNSText(info.name, mdns._TYPE_TXT,
+                                         mdns._CLASS_IN, self.__ttl,
+                                         info.text), 0)
+        self.__zeroconf.send(out)
+
+
+    def __filter(self, infos, now, check_names):
+        """
+        Removes the cancelled services and, while probing, those whose name is
+        already used
+
+        :param infos: A list of ServiceInfo beans
+        :param now: Current time (ms)
+        :param check_names: If True, remove the services whose name is found
+                            in the cache
+        :return: The list of services to keep
+        """
+        with self.__lock:
+            cancelled = self.__cancelled.copy()
+
+        result = []
+        for info in infos:
+            if info.name in cancelled:
+                continue
+
+            elif not check_names:
+                # Announcing: our own records are in the cache
+                result.append(info)
+                continue
+
+            for record in self.__zeroconf.cache.entriesWithName(info.type):
+                if record.type == mdns._TYPE_PTR \
+                        and not record.isExpired(now) \
+                        and record.alias == info.name:
+                    _logger.warning("Service name already in use: %s",
+                                    info.name)
+                    break
+
+            else:
+                result.append(info)
+
+        return result
+
+
+    def __send_rounds(self, infos, flags, fill_packet, delay, check_names):
+        """
+        Sends ANNOUNCE_ROUNDS series of packets describing the given services
+
+        :param infos: A list of ServiceInfo beans
+        :param flags: Flags of the packets
+        :param fill_packet: Method called with (packet, ServiceInfo) to add
+                            the records of a service to a packet
+        :param delay: Time between two series (ms)
+        :param check_names: If True, drop the services whose name is used by
+                            another host (probe rounds)
+        :return: The services still valid after the last series
+        """
+        zeroconf = self.__zeroconf
+        now = mdns.currentTimeMillis()
+        next_time = now
+        rounds = 0
+        while rounds < ANNOUNCE_ROUNDS and infos and not self.__stopped:
+            infos = self.__filter(infos, now, check_names)
+            if now < next_time:
+                zeroconf.wait(next_time - now)
+                now = mdns.currentTimeMillis()
+                continue
+
+            for group in _split_packets(infos, len(self.__extra_addresses)):
+                out = mdns.DNSOutgoing(flags)
+                for info in group:
+                    fill_packet(out, info)
+
+                zeroconf.send(out)
+
+            rounds += 1
+            next_time += delay
+
+        return infos
+
+
+    def __fill_probe(self, out, info):
+        """
+        Adds the probe records of a service to a packet
+        """
+        out.addQuestion(mdns.DNSQuestion(info.type, mdns._TYPE_PTR,
+                                         mdns._CLASS_IN))
+        out.addAuthorativeAnswer(mdns.DNSPointer(info.type, mdns._TYPE_PTR,
+                                                 mdns._CLASS_IN, self.__ttl,
+                                                 info.name))
+
+
+    def __fill_announce(self, out, info):
+        """
+        Adds the records of a service to an announcement packet
+        """
+        ttl = self.__ttl
+        out.addAnswerAtTime(mdns.DNSPointer(info.type, mdns._TYPE_PTR,
+                                            mdns._CLASS_IN, ttl, info.name), 0)
+        out.addAnswerAtTime(mdns.DNSService(info.name, mdns._TYPE_SRV,
+                                            mdns._CLASS_IN, ttl, info.priority,
+                                            info.weight, info.port,
+                                            info.server), 0)
+        out.addAnswerAtTime(mdns.DNSText(info.name, mdns._TYPE_TXT,
+                                         mdns._CLASS_IN, ttl, info.text), 0)
+        if info.address:
+            out.addAnswerAtTime(mdns.DNSAddress(info.server, mdns._TYPE_A,
+                                                mdns._CLASS_IN, ttl,
+                                                info.address), 0)
+
+        for record_type, address in self.__extra_addresses:
+            out.addAnswerAtTime(mdns.DNSAddress(info.server, record_type,
+                                                mdns._CLASS_IN, ttl, address),
+                                0)
+
+
+    def __announce(self, infos):
+        """
+        Probes then announces the given services
+
+        :param infos: A list of ServiceInfo beans
+        :return: The list of registered services
+        """
+        # Check that nobody else uses the names
+        infos = self.__send_rounds(infos,
+                                   mdns._FLAGS_QR_QUERY | mdns._FLAGS_AA,
+                                   self.__fill_probe, mdns._CHECK_TIME, True)
+        if not infos or self.__stopped:
+            return []
+
+        # Answer queries about the services from now on
+        services = self.__zeroconf.services
+        for info in infos:
+            services[info.name.lower()] = info
+
+        registered = infos[:]
+        self.__send_rounds(infos, mdns._FLAGS_QR_RESPONSE | mdns._FLAGS_AA,
+                           self.__fill_announce, mdns._REGISTER_TIME, False)
+        return registered
+
+
+    def __loop(self):
+        """
+        Worker thread loop
+        """
+        while not self.__stopped:
+            self.__event.wait()
+            self.__event.clear()
+            if self.__stopped:
+                break
+
+            # Let other registrations join this announcement
+            time.sleep(ANNOUNCE_DELAY / 1000.0)
+
+            with self.__lock:
+                batch = self.__pending[:]
+                del self.__pending[:]
+                self.__current.update(info.name for info in batch)
+
+            registered = []
+            try:
+                if batch:
+                    registered = self.__announce(batch)
+
+            except Exception as ex:
+                _logger.exception("Error announcing services: %s", ex)
+
+            finally:
+                with self.__lock:
+                    cancelled = [info for info in registered
+                                 if info.name in self.__cancelled]
+                    self.__current.clear()
+                    self.__cancelled.clear()
+
+            for info in cancelled:
+                # Unregistered during the announcement
+                self.__zeroconf.unregisterService(info)
+
 # ------------------------------------------------------------------------------
 
 @ComponentFactory("experiment-zeroconf-discovery-factory")
@@ -94,16 +914,32 @@ class ZeroconfDiscovery(object):
         # Framework UID
         self._fw_uid = None
 
+        # Host addresses: (family, address) tuples, and the packed address of
+        # the A records
+        self._addresses = []
+        self._address = None
+
         # Zeroconf
         self._zeroconf = None
         self._browsers = []
+        self._resolver = None
+        self._announcer = None
 
         # Endpoint UID -> ServiceInfo
         self._export_infos = {}
 
+        # Endpoint UID -> version of its properties
+        self._export_versions = {}
+
         # mDNS name -> Endpoint UID
         self._imported_endpoints = {}
 
+        # mDNS name -> _CachedService
+        self._services_cache = {}
+
+        # Lock of the cache and of the imported endpoints
+        self._lock = threading.RLock()
+
 
     @Invalidate
     def invalidate(self, context):
@@ -114,14 +950,30 @@ class ZeroconfDiscovery(object):
         for browser in self._browsers:
             browser.cancel()
 
+        del self._browsers[:]
+        self._zeroconf.removeListener(self)
+
+        # Stop resolving services
+        self._resolver.stop()
+        self._resolver = None
+
+        # Stop announcing services
+        self._announcer.stop()
+        self._announcer = None
+
         # Close Zeroconf
         self._zeroconf.unregisterAllServices()
         self._zeroconf.close()
 
         # Clean up
         self._export_infos.clear()
+        self._export_versions.clear()
+        with self._lock:
+            self._services_cache.clear()
         self._zeroconf = None
         self._fw_uid = None
+        self._address = None
+        del self._addresses[:]
 
         _logger.debug("Zeroconf discovery invalidated")
 
@@ -134,16 +986,48 @@ class ZeroconfDiscovery(object):
         # Get the framework UID
         self._fw_uid = context.get_property(pelix.framework.FRAMEWORK_UID)
 
-        # Get the host address
-        self._address = socket.inet_aton(socket.gethostbyname(
-                                                          socket.gethostname()))
+        # Get the host addresses, once for all
+        self._addresses = get_host_addresses()
+        if self._addresses and self._addresses[0][0] == socket.AF_INET:
+            # Main IPv4 address in A records, others as additional records
+            self._address = socket.inet_aton(self._addresses[0][1])
+            others = self._addresses[1:]
+
+        else:
+            # No usable IPv4 address
+            self._address = socket.inet_aton("127.0.0.1")
+            others = self._addresses
+
+        extra_addresses = []
+        for family, address in others:
+            if family == socket.AF_INET:
+                extra_addresses.append((mdns._TYPE_A,
+                                        socket.inet_aton(address)))
+
+            else:
+                extra_addresses.append((mdns._TYPE_AAAA,
+                                        socket.inet_pton(family, address)))
 
         # Prepare Zeroconf
         self._zeroconf = mdns.Zeroconf("0.0.0.0")
 
+        # Start the resolution thread
+        self._resolver = _ServiceResolver(self._zeroconf,
+                                          self._service_resolved)
+        self._resolver.start()
+
+        # Start the registration thread
+        self._announcer = _ServiceAnnouncer(self._zeroconf,
+                                            ZeroconfDiscovery.TTL,
+                                            extra_addresses)
+        self._announcer.start()
+
         # Register the dispatcher servlet as a service
         self.__register_servlet()
 
+        # Listen to TXT records updates
+        self._zeroconf.addListener(self, None)
+
         # Listen to our types
         self._browsers.append(mdns.ServiceBrowser(self._zeroconf,
                                         ZeroconfDiscovery.DNS_DISPATCHER_TYPE,
@@ -157,21 +1041,9 @@ class ZeroconfDiscovery(object):
 
     def _serialize_properties(self, props):
         """
-        Converts properties values into strings
+        Converts properties values into typed strings (see txt_codec)
         """
-        new_props = {}
-
-        for key, value in props.items():
-            if is_string(value):
-                new_props[key] = value
-
-            else:
-                try:
-                    new_props[key] = json.dumps(value)
-
-                except ValueError:
-                    new_props[key] = "pelix-type:{0}:{1}" \
-                                     .format(type(value).__name__, repr(value))
+        new_props = txt_codec.encode_properties(props)
 
         # FIXME: for use with ECF
         try:
@@ -185,35 +1057,11 @@ class ZeroconfDiscovery(object):
 
     def _deserialize_properties(self, props):
         """
-        Converts properties values into their type
+        Converts properties values into their type.
+        Legacy "pelix-type:" values are kept as strings: they are never
+        evaluated.
         """
-        new_props = {}
-
-        for key, value in props.items():
-            try:
-                try:
-                    new_props[key] = json.loads(value)
-
-                except ValueError:
-                    if value.startswith("pelix-type:"):
-                        # Pseudo-serialized
-                        value_type, value = value.split(":", 3)[2:]
-                        if '.' in value_type:
-                            # Not a builtin type...
-                            if value_type not in value:
-                                _logger.debug("Won't work: %s (%s)",
-                                              value, value_type)
-
-                        new_props[key] = eval(value)
-
-                    else:
-                        # String
-                        new_props[key] = value
-
-            except Exception as ex:
-                _logger.error("Can't deserialize %s: %s", value, ex)
-
-        return new_props
+        return txt_codec.decode_properties(props)
 
 
     def __register_servlet(self):
@@ -228,7 +1076,9 @@ class ZeroconfDiscovery(object):
         properties = {"pelix.version": pelix.__version__,
                       pelix.remote.PROP_ENDPOINT_FRAMEWORK_UUID: self._fw_uid,
                       "pelix.access.port": access[0],
-                      "pelix.access.path": access[1]}
+                      "pelix.access.path": access[1],
+                      PROP_ACCESS_ADDRESSES: [address for _, address
+                                              in self._addresses]}
         properties = self._serialize_properties(properties)
 
         # Prepare the mDNS entry
@@ -241,7 +1091,7 @@ class ZeroconfDiscovery(object):
                                 )
 
         # Register the service
-        self._zeroconf.registerService(info, ZeroconfDiscovery.TTL)
+        self._announcer.register([info])
 
 
     def endpoints_added(self, endpoints):
@@ -253,9 +1103,9 @@ class ZeroconfDiscovery(object):
         # Get the dispatcher servlet port
         access_port = self._access.get_access()[0]
 
-        # Handle each one separately
-        for endpoint in endpoints:
-            self._endpoint_added(endpoint, access_port)
+        # Register all services in the same announcement
+        self._announcer.register([self._endpoint_added(endpoint, access_port)
+                                  for endpoint in endpoints])
 
 
     def _endpoint_added(self, exp_endpoint, access_port):
@@ -264,6 +1114,7 @@ class ZeroconfDiscovery(object):
 
         :param exp_endpoint: An ExportEndpoint bean
         :param access_port: The dispatcher access port
+        :return: The ServiceInfo bean to register
         """
         # Convert the export endpoint into an EndpointDescription bean
         endpoint = beans.from_export(exp_endpoint)
@@ -288,17 +1139,36 @@ class ZeroconfDiscovery(object):
                                 )
 
         self._export_infos[exp_endpoint.uid] = info
-
-        # Register the service
-        self._zeroconf.registerService(info, ZeroconfDiscovery.TTL)
+        return info
 
 
     def endpoint_updated(self, endpoint, old_properties):
         """
-        An end point is updated
+        An end point is updated: only its TXT record is published again, with
+        a new version number
+
+        :param endpoint: The updated ExportEndpoint bean
+        :param old_properties: The previous properties of the endpoint
         """
-        # Not available...
-        return
+        try:
+            info = self._export_infos[endpoint.uid]
+
+        except KeyError:
+            # Unknown service
+            _logger.debug("Unknown updated endpoint: %s", endpoint)
+            return
+
+        version = self._export_versions.get(endpoint.uid, 0) + 1
+        self._export_versions[endpoint.uid] = version
+
+        # Convert the new properties
+        properties = beans.from_export(endpoint).get_properties()
+        properties[PROP_ENDPOINT_VERSION] = version
+
+        old_text = info.text
+        info.setProperties(self._serialize_properties(properties))
+        if info.text != old_text:
+            self._announcer.update_text(info, old_text)
 
 
     def endpoint_removed(self, endpoint):
@@ -308,6 +1178,7 @@ class ZeroconfDiscovery(object):
         try:
             # Get the associated service info
             info = self._export_infos.pop(endpoint.uid)
+            self._export_versions.pop(endpoint.uid, None)
 
         except KeyError:
             # Unknown service
@@ -315,47 +1186,191 @@ class ZeroconfDiscovery(object):
 
         else:
             # Unregister the service
-            self._zeroconf.unregisterService(info)
+            self._announcer.unregister(info)
 
 
-    def _get_service_info(self, svc_type, name, max_retries=10):
+    def addService(self, zeroconf, svc_type, name):
         """
-        Tries to get information about the given mDNS service
+        Called by Zeroconf when a record is updated
 
+        :param zeroconf: The Zeroconf instance than notifies of the modification
         :param svc_type: Service type
         :param name: Service name
-        :param max_retries: Number of retries before timeout
-        :return: A ServiceInfo bean
-        """
-        info = None
-        retries = 0
-        while self._zeroconf is not None \
-        and info is None \
-        and retries < max_retries:
-            # Try to get information about the service...
-            info = self._zeroconf.getServiceInfo(svc_type, name)
-            retries += 1
+        """
+        with self._lock:
+            cached = self._services_cache.get(name)
+            if cached is not None \
+                    and cached.expiration > mdns.currentTimeMillis():
+                # Known service, records are still valid
+                self._handle_service(svc_type, name, cached)
+                return
 
-        return info
+            # Get information about the service, without blocking the browser
+            self._resolver.resolve(svc_type, name)
 
 
-    def addService(self, zeroconf, svc_type, name):
+    def __get_expiration(self, name):
         """
-        Called by Zeroconf when a record is updated
+        Computes the expiration and refresh times of the records of a service,
+        according to the TTL of its TXT record
+
+        :param name: Service name
+        :return: A (expiration, refresh) tuple (ms)
+        """
+        now = mdns.currentTimeMillis()
+        record = self._zeroconf.cache.getByDetails(name, mdns._TYPE_TXT,
+                                                   mdns._CLASS_IN)
+        if record is None or record.isExpired(now):
+            # Use our own TTL
+            ttl = ZeroconfDiscovery.TTL * 1000
+            return now + ttl, now + ttl * REFRESH_PERCENT // 100
+
+        return record.getExpirationTime(100), \
+            record.getExpirationTime(REFRESH_PERCENT)
+
+
+    def _service_resolved(self, svc_type, name, info):
+        """
+        Called by the resolver when the information about a service has been
+        received
 
-        :param zeroconf: The Zeroconf instance than notifies of the modification
         :param svc_type: Service type
         :param name: Service name
+        :param info: A ServiceInfo bean, or None on timeout
         """
-        # Get information about the service
-        info = self._get_service_info(svc_type, name)
         if info is None:
-            _logger.warning("Timeout reading service information: %s - %s",
-                            svc_type, name)
+            with self._lock:
+                refreshed = self._services_cache.pop(name, None) is not None
+
+            if refreshed:
+                # Failed refresh: the browser will see the service go away
+                _logger.debug("Service records not refreshed: %s", name)
+
+            else:
+                _logger.warning("Timeout reading service information: %s - %s",
+                                svc_type, name)
             return
 
-        # Read properties
-        properties = self._deserialize_properties(info.getProperties())
+        expiration, refresh = self.__get_expiration(name)
+
+        with self._lock:
+            cached = self._services_cache.get(name)
+            if cached is not None:
+                # Refreshed records: handle the service again only if its
+                # content changed
+                changed = cached.text != info.text
+                if changed:
+                    # New content
+                    self.__update_service(name, cached, info.text,
+                                          self._deserialize_properties(
+                                                        info.getProperties()))
+
+                # Update the times
+                cached.expiration = expiration
+                cached.address = info.getAddress()
+                cached.port = info.getPort()
+
+            else:
+                # Read properties
+                properties = self._deserialize_properties(
+                                                        info.getProperties())
+                if properties.get(pelix.remote.PROP_ENDPOINT_FRAMEWORK_UUID) \
+                        == self._fw_uid:
+                    # One of our services: don't keep it nor refresh it
+                    return
+
+                changed = True
+                cached = _CachedService(info, properties, expiration)
+                self._services_cache[name] = cached
+
+            # Refresh records before they expire
+            self._resolver.schedule_refresh(svc_type, name, refresh,
+                                            expiration)
+
+            if changed:
+                self._handle_service(svc_type, name, cached)
+
+
+    def updateRecord(self, zeroconf, now, record):
+        """
+        Called by Zeroconf when a record is received: applies the updated TXT
+        records of known services
+
+        :param zeroconf: The Zeroconf instance
+        :param now: Current time (ms)
+        :param record: The received DNS record
+        """
+        if record.type != mdns._TYPE_TXT or record.isExpired(now):
+            # Not an update
+            return
+
+        with self._lock:
+            cached = self._services_cache.get(record.name)
+            if cached is None or cached.text == record.text:
+                # Unknown service or same content
+                return
+
+            # Parse the TXT record
+            info = mdns.ServiceInfo(ZeroconfDiscovery.DNS_RS_TYPE, record.name)
+            info.setText(record.text)
+            self.__update_service(record.name, cached, record.text,
+                                  self._deserialize_properties(
+                                                        info.getProperties()))
+
+
+    def __update_service(self, name, cached, text, properties):
+        """
+        Applies the new properties of a known service. If it has been imported,
+        its registry entry is updated with the properties which changed.
+
+        :param name: Service name
+        :param cached: The _CachedService bean describing the service
+        :param text: The new content of its TXT record
+        :param properties: The new deserialized properties
+        """
+        old_properties = cached.properties
+        if properties.get(PROP_ENDPOINT_VERSION, 0) \
+                < old_properties.get(PROP_ENDPOINT_VERSION, 0):
+            # Late record
+            _logger.debug("Ignoring an old version of %s", name)
+            return
+
+        cached.text = text
+        cached.properties = properties
+
+        uid = self._imported_endpoints.get(name)
+        if uid is None:
+            # Not imported
+            return
+
+        # Compute the delta, ignoring the version
+        changed = dict((key, value) for key, value in properties.items()
+                       if key not in old_properties
+                       or old_properties[key] != value)
+        changed.pop(PROP_ENDPOINT_VERSION, None)
+        removed = [key for key in old_properties
+                   if key not in properties and key != PROP_ENDPOINT_VERSION]
+        if not changed and not removed:
+            return
+
+        new_properties = old_properties.copy()
+        new_properties.pop(PROP_ENDPOINT_VERSION, None)
+        new_properties.update(changed)
+        for key in removed:
+            del new_properties[key]
+
+        self._registry.update(uid, new_properties)
+
+
+    def _handle_service(self, svc_type, name, cached):
+        """
+        Handles a resolved service
+
+        :param svc_type: Service type
+        :param name: Service name
+        :param cached: The _CachedService bean describing the service
+        """
+        properties = cached.properties
 
         try:
             sender_uid = properties[pelix.remote.PROP_ENDPOINT_FRAMEWORK_UUID]
@@ -370,14 +1385,23 @@ class ZeroconfDiscovery(object):
 
         if svc_type == ZeroconfDiscovery.DNS_DISPATCHER_TYPE:
             # Dispatcher servlet found, get source info
-            address = to_str(socket.inet_ntoa(info.getAddress()))
-            port = info.getPort()
+            candidates = [to_str(socket.inet_ntoa(cached.address))]
+            others = properties.get(PROP_ACCESS_ADDRESSES, [])
+            if is_string(others):
+                others = [others]
+
+            candidates.extend(others)
+            address = select_address(candidates, self._addresses)
+            port = cached.port
 
             self._access.send_discovered(address, port,
                                          properties['pelix.access.path'])
 
         elif svc_type == ZeroconfDiscovery.DNS_RS_TYPE:
             # Remote service
+            if name in self._imported_endpoints:
+                # Already imported
+                return
 
             # Get the first available configuration
             configuration = properties[pelix.remote.PROP_IMPORTED_CONFIGS]
@@ -389,13 +1413,18 @@ class ZeroconfDiscovery(object):
             if is_string(specs):
                 specs = [specs]
 
+            # The version of the record is not an endpoint property
+            endpoint_properties = properties.copy()
+            endpoint_properties.pop(PROP_ENDPOINT_VERSION, None)
+
             try:
                 # Make an import bean
                 endpoint = beans.ImportEndpoint(
                                 properties[pelix.remote.PROP_ENDPOINT_ID],
                                 properties[pelix.remote.\
                                             PROP_ENDPOINT_FRAMEWORK_UUID],
-                                [configuration], None, specs, properties)
+                                [configuration], None, specs,
+                                endpoint_properties)
 
             except KeyError as ex:
                 # Log a warning on incomplete endpoints
@@ -418,16 +1447,17 @@ class ZeroconfDiscovery(object):
         :param svc_type: Service type
         :param name: Service name
         """
-        if svc_type == ZeroconfDiscovery.DNS_RS_TYPE:
-            # Get information about the service
-            try:
-                # Get the stored endpoint UID
-                uid = self._imported_endpoints.pop(name)
+        # Stop resolving the service (waits for the end of its notification)
+        self._resolver.cancel(name)
 
-            except KeyError:
-                # Unknown service
+        with self._lock:
+            # Forget its records
+            self._services_cache.pop(name, None)
+            if svc_type != ZeroconfDiscovery.DNS_RS_TYPE:
                 return
 
-            else:
+            # Get the stored endpoint UID
+            uid = self._imported_endpoints.pop(name, None)
+            if uid is not None:
                 # Remove it
                 self._registry.remove(uid)
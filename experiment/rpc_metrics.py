@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Pelix remote services: per-endpoint call metrics
+
+Calls are accumulated in thread-local tables, without any lock on the call
+path, and merged only when a snapshot is requested.
+Latencies are stored in a log-linear histogram with fixed buckets (HDR-style),
+which gives percentiles with a bounded relative error at a constant memory cost.
+
+:author: Thomas Calmant
+:copyright: Copyright 2013, isandlaTech
+:license: Apache License 2.0
+:version: 0.1
+:status: Alpha
+
+..
+
+    Copyright 2013 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 1, 0)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Shell constants
+from pelix.shell import SHELL_COMMAND_SPEC
+
+# iPOPO decorators
+from pelix.ipopo.decorators import ComponentFactory, Provides, Property, \
+    Instantiate, Validate, Invalidate
+
+# Standard library
+import threading
+import time
+
+# ------------------------------------------------------------------------------
+
+SERVICE_RPC_METRICS = "experiment.rpc.metrics"
+""" Specification of the call metrics service """
+
+PROP_METRICS_ENABLED = "rpc.metrics.enabled"
+""" Component property: if False, the service records nothing """
+
+SIDE_EXPORT = "export"
+""" Calls received by an exporter """
+
+SIDE_IMPORT = "import"
+""" Calls emitted by an imported service proxy """
+
+SUB_BUCKETS_BITS = 3
+""" Bits of precision kept inside a power of 2 (8 sub-buckets, 12.5% error) """
+
+MAX_MAGNITUDE = 36
+""" Highest power of 2 of microseconds in the histogram (~19 hours) """
+
+NB_BUCKETS = (MAX_MAGNITUDE - SUB_BUCKETS_BITS + 2) << SUB_BUCKETS_BITS
+""" Number of buckets in a latency histogram """
+
+# ------------------------------------------------------------------------------
+
+try:
+    # Python 3.3+: monotonic, high resolution timer
+    timer = time.perf_counter
+
+except AttributeError:
+    # Python 2
+    timer = time.time
+
+# ------------------------------------------------------------------------------
+
+def bucket_index(micros):
+    """
+    Computes the index of the histogram bucket for the given latency
+
+    :param micros: A latency, in microseconds (int)
+    :return: The index of the bucket
+    """
+    if micros < (1 << SUB_BUCKETS_BITS):
+        # Small values are stored exactly
+        return max(micros, 0)
+
+    # Power of 2 and the next bits give the bucket
+    magnitude = micros.bit_length() - 1
+    if magnitude > MAX_MAGNITUDE:
+        return NB_BUCKETS - 1
+
+    shift = magnitude - SUB_BUCKETS_BITS
+    return ((shift + 1) << SUB_BUCKETS_BITS) \
+        + ((micros >> shift) & ((1 << SUB_BUCKETS_BITS) - 1))
+
+
+def bucket_upper_bound(index):
+    """
+    Returns the highest latency (in microseconds) stored in the given bucket
+
+    :param index: Index of a bucket
+    :return: A latency in microseconds
+    """
+    if index < (1 << SUB_BUCKETS_BITS):
+        return index
+
+    shift = (index >> SUB_BUCKETS_BITS) - 1
+    sub_bucket = index & ((1 << SUB_BUCKETS_BITS) - 1)
+    return (((1 << SUB_BUCKETS_BITS) + sub_bucket + 1) << shift) - 1
+
+# ------------------------------------------------------------------------------
+
+class MethodStatistics(object):
+    """
+    Statistics of the calls to a single method of an endpoint
+    """
+    __slots__ = ('calls', 'errors', 'bytes_in', 'bytes_out', 'total_time',
+                 'max_time', 'histogram')
+
+    def __init__(self):
+        """
+        Sets up members
+        """
+        self.calls = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * NB_BUCKETS
+
+
+    def merge(self, other):
+        """
+        Adds the values of the given statistics to this one
+
+        :param other: Another MethodStatistics bean
+        """
+        self.calls += other.calls
+        self.errors += other.errors
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+
+        histogram = self.histogram
+        for idx, count in enumerate(other.histogram):
+            if count:
+                histogram[idx] += count
+
+
+    def mean(self):
+        """
+        Returns the mean latency of calls, in seconds
+        """
+        if not self.calls:
+            return 0.0
+
+        return self.total_time / self.calls
+
+
+    def percentile(self, percent):
+        """
+        Returns the latency under which the given percentage of calls were
+        answered, in seconds, according to the histogram resolution
+
+        :param percent: A percentage (0-100)
+        :return: A latency in seconds
+        """
+        if not self.calls:
+            return 0.0
+
+        threshold = self.calls * percent / 100.0
+        seen = 0
+        for idx, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= threshold:
+                # Don't go over the highest value seen
+                return min(bucket_upper_bound(idx) / 1000000.0, self.max_time)
+
+        return self.max_time
+
+# ------------------------------------------------------------------------------
+
+class CallMetrics(object):
+    """
+    Lock-free (on the call path) metrics store.
+
+    Each thread accumulates its values in its own table, which is registered
+    once, the first time the thread records a call. Snapshots merge all tables.
+    """
+    def __init__(self):
+        """
+        Sets up members
+        """
+        # Thread-local table: (side, endpoint, method) -> MethodStatistics
+        self.__local = threading.local()
+
+        # Thread tables: (Thread, table) tuples, only modified when a new
+        # thread records its first call
+        self.__tables = []
+
+        # Values recorded by threads which are now dead
+        self.__retired = {}
+
+        # Incremented on reset: threads then start a new table instead of
+        # having their current one cleared while they write in it
+        self.__generation = 0
+
+        self.__lock = threading.Lock()
+
+
+    def __get_table(self):
+        """
+        Returns the statistics table of the current thread
+        """
+        local = self.__local
+        try:
+            if local.generation == self.__generation:
+                return local.table
+
+        except AttributeError:
+            # First call from this thread
+            pass
+
+        # First call from this thread or since the last reset
+        table = {}
+        with self.__lock:
+            # HTTP servers can use a thread per request: fold the tables
+            # of dead threads to keep the list short
+            self.__retire_dead_threads()
+            self.__tables.append((threading.current_thread(), table))
+            local.table = table
+            local.generation = self.__generation
+
+        return table
+
+
+    def __retire_dead_threads(self):
+        """
+        Merges the tables of dead threads into the retired table.
+        Must be called while holding the lock.
+        """
+        alive = []
+        for thread, table in self.__tables:
+            if thread.is_alive():
+                alive.append((thread, table))
+
+            else:
+                # The thread can't write in its table anymore
+                self.__merge_table(self.__retired, table)
+
+        self.__tables[:] = alive
+
+
+    @staticmethod
+    def __merge_table(result, table):
+        """
+        Merges the given statistics table into the result one
+
+        :param result: Table to update
+        :param table: Table to merge
+        """
+        # Copy the items: the owner thread might add a key meanwhile
+        for key, stats in list(table.items()):
+            try:
+                result[key].merge(stats)
+
+            except KeyError:
+                merged = result[key] = MethodStatistics()
+                merged.merge(stats)
+
+
+    def record(self, side, endpoint, method, duration, error=False,
+               bytes_in=0, bytes_out=0):
+        """
+        Records a call
+
+        :param side: SIDE_EXPORT or SIDE_IMPORT
+        :param endpoint: Name of the endpoint
+        :param method: Name of the called method
+        :param duration: Duration of the call, in seconds
+        :param error: True if the call failed
+        :param bytes_in: Size of the received payload
+        :param bytes_out: Size of the sent payload
+        """
+        table = self.__get_table()
+        key = (side, endpoint, method)
+        try:
+            stats = table[key]
+
+        except KeyError:
+            stats = table[key] = MethodStatistics()
+
+        stats.calls += 1
+        if error:
+            stats.errors += 1
+
+        stats.bytes_in += bytes_in
+        stats.bytes_out += bytes_out
+        stats.total_time += duration
+        if duration > stats.max_time:
+            stats.max_time = duration
+
+        stats.histogram[bucket_index(int(duration * 1000000))] += 1
+
+
+    def snapshot(self):
+        """
+        Merges the tables of all threads
+
+        :return: A (side, endpoint, method) -> MethodStatistics dictionary
+        """
+        result = {}
+        with self.__lock:
+            self.__retire_dead_threads()
+            self.__merge_table(result, self.__retired)
+            for _, table in self.__tables:
+                self.__merge_table(result, table)
+
+        return result
+
+
+    def reset(self):
+        """
+        Clears all recorded values.
+
+        The tables of living threads are only forgotten: their owners start
+        new ones on their next call.
+        """
+        with self.__lock:
+            self.__generation += 1
+            self.__retired.clear()
+            del self.__tables[:]
+
+# ------------------------------------------------------------------------------
+
+@ComponentFactory("experiment-rpc-metrics-factory")
+@Provides((SERVICE_RPC_METRICS, SHELL_COMMAND_SPEC))
+@Property('enabled', PROP_METRICS_ENABLED, True)
+@Instantiate("experiment-rpc-metrics")
+class RpcMetrics(CallMetrics):
+    """
+    Call metrics service, with its shell commands.
+
+    Providers check the ``enabled`` member before measuring a call, so that a
+    disabled service costs a single attribute test.
+    """
+    def __init__(self):
+        """
+        Sets up members
+        """
+        CallMetrics.__init__(self)
+
+
+    @Validate
+    def validate(self, context):
+        """
+        Component validated
+        """
+        self.reset()
+
+
+    @Invalidate
+    def invalidate(self, context):
+        """
+        Component invalidated
+        """
+        self.reset()
+
+
+    def get_namespace(self):
+        """
+        Shell namespace
+        """
+        return "metrics"
+
+
+    def get_methods(self):
+        """
+        Shells commands
+        """
+        return [("show", self.show),
+                ("reset", self.shell_reset),
+                ("enable", self.enable),
+                ("disable", self.disable)]
+
+
+    def show(self, io_handler, endpoint=None):
+        """
+        Prints the call metrics, optionally filtered by endpoint name
+        """
+        stats = self.snapshot()
+        if endpoint:
+            stats = dict((key, value) for key, value in stats.items()
+                         if key[1] == endpoint)
+
+        if not stats:
+            io_handler.write_line("No call recorded")
+            return
+
+        line_format = "{0:<6} {1:<30} {2:<20} {3:>8} {4:>6} {5:>10} {6:>10} " \
+                      "{7:>9} {8:>9} {9:>9} {10:>9}"
+        io_handler.write_line(line_format, "Side", "Endpoint", "Method",
+                              "Calls", "Errors", "Bytes in", "Bytes out",
+                              "Mean ms", "p50 ms", "p99 ms", "Max ms")
+
+        for key in sorted(stats):
+            side, name, method = key
+            method_stats = stats[key]
+            io_handler.write_line(line_format, side, name, method,
+                                  method_stats.calls, method_stats.errors,
+                                  method_stats.bytes_in, method_stats.bytes_out,
+                                  "{0:.3f}".format(method_stats.mean() * 1000),
+                                  "{0:.3f}".format(
+                                        method_stats.percentile(50) * 1000),
+                                  "{0:.3f}".format(
+                                        method_stats.percentile(99) * 1000),
+                                  "{0:.3f}".format(
+                                        method_stats.max_time * 1000))
+
+
+    def shell_reset(self, io_handler):
+        """
+        Clears the call metrics
+        """
+        self.reset()
+        io_handler.write_line("Metrics cleared")
+
+
+    def enable(self, io_handler):
+        """
+        Starts recording calls
+        """
+        self.enabled = True
+        io_handler.write_line("Metrics enabled")
+
+
+    def disable(self, io_handler):
+        """
+        Stops recording calls
+        """
+        self.enabled = False
+        io_handler.write_line("Metrics disabled")
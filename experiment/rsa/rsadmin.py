@@ -245,9 +245,9 @@ class RemoteServiceAdmin(object):
 
                 # Register the service
                 svc_reg = self._context.register_service(
-                                                    endpoint.get_interfaces(),
-                                                    proxy,
-                                                    endpoint.get_properties())
+                                            list(endpoint.get_interfaces()),
+                                            proxy,
+                                            dict(endpoint.get_properties()))
                 svc_ref = svc_reg.get_service_reference()
 
                 # Prepare an import reference bean
@@ -14,11 +14,12 @@ __docformat__ = "restructuredtext en"
 # ------------------------------------------------------------------------------
 
 # Experiment
+import experiment.beans as beans
 import experiment.rsa
 
 # Pelix
 from pelix.ipopo.decorators import ComponentFactory, Provides, Instantiate, \
-    Validate, Invalidate, Requires
+    Validate, Invalidate, Requires, Property
 
 # Standard library
 import logging
@@ -32,11 +33,16 @@ _logger = logging.getLogger(__name__)
 @ComponentFactory()
 @Provides(experiment.rsa.SERVICE_ENDPOINT_LISTENER)
 @Requires('_rsadmin', experiment.rsa.SERVICE_RS_ADMIN)
+@Property('_import_versions', 'topology.import.versions', None)
 @Instantiate('osgi-remote-topology-manager')
 class TopologyManager(object):
     """
     Listens to service and endpoint events to tell the remote service admin
-    to export and import services
+    to export and import services.
+
+    Endpoints are imported only if the versions of their packages are in the
+    ranges given by the "topology.import.versions" property
+    (package -> range string dictionary), if any.
     """
     def __init__(self):
         """
@@ -45,6 +51,12 @@ class TopologyManager(object):
         # Remove service Admin
         self._rsadmin = None
 
+        # Accepted package versions: Package -> range string
+        self._import_versions = None
+
+        # Parsed version ranges: Package -> VersionRange
+        self.__ranges = {}
+
         # Imported/Exported registrations: Endpoint UID -> [Registrations]
         self.__imported = {}
         self.__exported = {}
@@ -55,7 +67,11 @@ class TopologyManager(object):
         """
         Component validated
         """
-        pass
+        if self._import_versions:
+            # Parse ranges once
+            self.__ranges = dict((package, beans.parse_range(version_range))
+                                 for package, version_range
+                                 in self._import_versions.items())
 
 
     @Invalidate
@@ -64,7 +80,7 @@ class TopologyManager(object):
         Component invalidated
         """
         # TODO: unregister all endpoints
-        pass
+        self.__ranges = {}
 
 
     def endpointAdded(self, endpoint, matched_filter):
@@ -75,6 +91,10 @@ class TopologyManager(object):
         """
         # TODO: check import/export events
         if matched_filter is None:
+            if self.__ranges and not endpoint.matches_versions(self.__ranges):
+                _logger.debug("Incompatible package versions: %s", endpoint)
+                return
+
             # TODO: normalize the endpoint description before ?
             # TODO: store the registration
             self._rsadmin.import_service(endpoint)
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# -- Content-Encoding: UTF-8 --
+"""
+Pelix remote services: typed encoding of properties in DNS TXT records
+
+Values are stored as strings, with a type tag prefix when they are not plain
+strings or integers:
+
+* ``!b0``/``!b1``: boolean
+* ``!f<repr>``: float
+* ``!n``: None
+* ``!s<string>``: a string which would be ambiguous without a tag
+* ``!B<base64>``: bytes
+* ``!l``, ``!t``, ``!S`` followed by a JSON array of encoded values: list,
+  tuple, set
+* ``!d`` followed by a JSON object of encoded keys and values: dictionary
+* ``!r<repr>``: representation of an unsupported type, decoded as a string
+
+Untagged values are decoded as integers if they look like one, else as strings,
+which keeps them readable by peers unaware of this encoding.
+Nothing is ever evaluated while decoding.
+
+A TXT record entry (``key=value``) can't exceed 255 bytes: longer values are
+split in chunks, the first one being stored as ``!c<count>:<chunk>`` under the
+property key, the next ones under ``key#1``, ``key#2``...
+
+:author: Thomas Calmant
+:copyright: Copyright 2013, isandlaTech
+:license: Apache License 2.0
+:version: 0.1
+:status: Alpha
+
+..
+
+    Copyright 2013 isandlaTech
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+
+# Module version
+__version_info__ = (0, 1, 0)
+__version__ = ".".join(str(x) for x in __version_info__)
+
+# Documentation strings format
+__docformat__ = "restructuredtext en"
+
+# ------------------------------------------------------------------------------
+
+# Local
+from experiment.interning import intern_string, intern_value
+
+# Pelix
+from pelix.utilities import is_string, to_str
+
+# Standard library
+import base64
+import json
+import logging
+import re
+
+# ------------------------------------------------------------------------------
+
+_logger = logging.getLogger(__name__)
+
+TAG_PREFIX = "!"
+""" Prefix of typed values """
+
+CHUNK_SEPARATOR = "#"
+""" Separator between a property key and a chunk index """
+
+TXT_ENTRY_MAX_LENGTH = 255
+""" Maximum length of a TXT record entry, in bytes """
+
+_INT_PATTERN = re.compile(r"-?[0-9]+$")
+""" Untagged values matching this pattern are integers """
+
+_LEGACY_FLOAT_PATTERN = re.compile(r"-?[0-9]+(\.[0-9]+)?([eE][-+]?[0-9]+)?$")
+""" Floats written by peers using the previous (JSON) encoding """
+
+_LEGACY_LITERALS = frozenset(('false', 'null'))
+""" JSON literals written by peers using the previous encoding """
+
+_CHUNK_PATTERN = re.compile(r"!c([0-9]+):")
+""" Header of the first chunk of a split value """
+
+_CHUNK_OVERHEAD = 16
+""" Bytes reserved in each chunk for the chunk header or key suffix """
+
+_AMBIGUOUS_STRINGS = frozenset(('', 'true'))
+"""
+Strings which must be tagged: pyzeroconf reads empty values as None and 'true'
+as 1
+"""
+
+try:
+    # Python 2
+    _INTEGER_TYPES = (int, long)
+    _BYTES_TYPE = bytearray
+
+except NameError:
+    # Python 3
+    _INTEGER_TYPES = (int,)
+    _BYTES_TYPE = (bytes, bytearray)
+
+# ------------------------------------------------------------------------------
+
+def _is_legacy_json(value):
+    """
+    Tests if an untagged value can be a JSON value written by a peer using the
+    previous encoding (lists, dictionaries, floats, false and null)
+
+    :param value: A non-empty untagged string
+    :return: True if the value must be decoded as JSON
+    """
+    return value[0] in '[{' or value in _LEGACY_LITERALS \
+        or _LEGACY_FLOAT_PATTERN.match(value) is not None
+
+
+def _encode_array(tag, values):
+    """
+    Encodes an iterable of values
+
+    :param tag: Tag of the container type
+    :param values: Values of the container
+    :return: The encoded container
+    """
+    return TAG_PREFIX + tag + json.dumps([encode_value(value)
+                                          for value in values])
+
+
+def encode_value(value):
+    """
+    Converts a value to its typed string representation
+
+    :param value: A property value
+    :return: The encoded value (str)
+    """
+    if is_string(value):
+        if value in _AMBIGUOUS_STRINGS or value[0] == TAG_PREFIX \
+                or _is_legacy_json(value):
+            # Needs a tag to be read back as a string
+            return TAG_PREFIX + 's' + value
+
+        # Plain string
+        return value
+
+    elif value is None:
+        return TAG_PREFIX + 'n'
+
+    elif isinstance(value, bool):
+        # Must be tested before integers
+        return TAG_PREFIX + ('b1' if value else 'b0')
+
+    elif isinstance(value, _INTEGER_TYPES):
+        return str(value)
+
+    elif isinstance(value, float):
+        return TAG_PREFIX + 'f' + repr(value)
+
+    elif isinstance(value, list):
+        return _encode_array('l', value)
+
+    elif isinstance(value, tuple):
+        return _encode_array('t', value)
+
+    elif isinstance(value, (set, frozenset)):
+        return _encode_array('S', value)
+
+    elif isinstance(value, dict):
+        return TAG_PREFIX + 'd' + json.dumps(
+                            dict((encode_value(key), encode_value(content))
+                                 for key, content in value.items()))
+
+    elif isinstance(value, _BYTES_TYPE):
+        return TAG_PREFIX + 'B' + to_str(base64.b64encode(bytes(value)))
+
+    # Unsupported type: keep its representation, as a string
+    _logger.debug("Unsupported property type %s: stored as a string",
+                  type(value).__name__)
+    return TAG_PREFIX + 'r' + repr(value)
+
+
+def _decode_bool(payload):
+    """
+    Decodes a boolean payload
+    """
+    return payload == '1'
+
+
+def _decode_none(payload):
+    """
+    Decodes a None payload
+    """
+    return None
+
+
+def _decode_string(payload):
+    """
+    Decodes a string payload (also used for representations)
+    """
+    return payload
+
+
+def _decode_list(payload):
+    """
+    Decodes a list payload
+    """
+    return [decode_value(value) for value in json.loads(payload)]
+
+
+def _decode_tuple(payload):
+    """
+    Decodes a tuple payload
+    """
+    return tuple(decode_value(value) for value in json.loads(payload))
+
+
+def _decode_set(payload):
+    """
+    Decodes a set payload
+    """
+    return set(decode_value(value) for value in json.loads(payload))
+
+
+def _decode_dict(payload):
+    """
+    Decodes a dictionary payload
+    """
+    return dict((decode_value(key), decode_value(value))
+                for key, value in json.loads(payload).items())
+
+
+def _decode_bytes(payload):
+    """
+    Decodes a bytes payload
+    """
+    return base64.b64decode(payload.encode('ascii'))
+
+
+_DECODERS = {'b': _decode_bool,
+             'n': _decode_none,
+             's': _decode_string,
+             'r': _decode_string,
+             'f': float,
+             'l': _decode_list,
+             't': _decode_tuple,
+             'S': _decode_set,
+             'd': _decode_dict,
+             'B': _decode_bytes}
+""" Type tag -> payload decoder """
+
+
+def decode_value(value):
+    """
+    Converts a typed string representation to its value
+
+    :param value: An encoded value (str)
+    :return: The decoded value
+    """
+    if not value or value[0] != TAG_PREFIX:
+        if _INT_PATTERN.match(value) is not None:
+            return int(value)
+
+        elif _is_legacy_json(value):
+            # Value from a peer using the previous encoding
+            try:
+                return json.loads(value)
+
+            except ValueError:
+                pass
+
+        # Plain string
+        return value
+
+    try:
+        decoder = _DECODERS[value[1:2]]
+
+    except KeyError:
+        # Unknown tag: keep the raw string
+        return value
+
+    try:
+        return decoder(value[2:])
+
+    except (ValueError, TypeError) as ex:
+        _logger.error("Can't decode %s: %s", value, ex)
+        return value
+
+# ------------------------------------------------------------------------------
+
+def _split_value(value, max_bytes):
+    """
+    Splits a string in chunks whose UTF-8 form doesn't exceed the given size
+
+    :param value: A string
+    :param max_bytes: Maximum size of a chunk, in bytes
+    :return: A list of strings
+    """
+    if len(value.encode('UTF-8')) == len(value):
+        # ASCII: one character per byte
+        return [value[idx:idx + max_bytes]
+                for idx in range(0, len(value), max_bytes)]
+
+    chunks = []
+    current = []
+    current_size = 0
+    for char in value:
+        char_size = len(char.encode('UTF-8'))
+        if current_size + char_size > max_bytes:
+            chunks.append(''.join(current))
+            current = []
+            current_size = 0
+
+        current.append(char)
+        current_size += char_size
+
+    chunks.append(''.join(current))
+    return chunks
+
+
+def encode_properties(properties):
+    """
+    Encodes the given properties, splitting the values exceeding the size of
+    a TXT record entry
+
+    :param properties: A dictionary of properties
+    :return: A dictionary of strings
+    """
+    result = {}
+    for key, value in properties.items():
+        encoded = encode_value(value)
+
+        # key=value
+        max_bytes = TXT_ENTRY_MAX_LENGTH - len(key.encode('UTF-8')) - 1
+        if len(encoded) * 4 <= max_bytes \
+                or len(encoded.encode('UTF-8')) <= max_bytes:
+            result[key] = encoded
+            continue
+
+        # Too long: split it
+        chunks = _split_value(encoded, max_bytes - _CHUNK_OVERHEAD)
+        result[key] = "{0}c{1}:{2}".format(TAG_PREFIX, len(chunks), chunks[0])
+        for idx, chunk in enumerate(chunks[1:], 1):
+            result["{0}{1}{2}".format(key, CHUNK_SEPARATOR, idx)] = chunk
+
+    return result
+
+
+def decode_properties(properties):
+    """
+    Decodes the given properties, joining split values. Keys and string
+    values are interned.
+
+    :param properties: A dictionary of properties, as read from a TXT record
+    :return: A dictionary of decoded properties
+    """
+    # Convert keys and values to strings
+    raw = {}
+    for key, value in properties.items():
+        if isinstance(value, bytes) or is_string(value):
+            value = to_str(value)
+
+        raw[to_str(key)] = value
+
+    result = {}
+    for key, value in raw.items():
+        if not is_string(value):
+            # Value already converted by the DNS library
+            result[intern_string(key)] = value
+            continue
+
+        if value.startswith(TAG_PREFIX + 'c'):
+            match = _CHUNK_PATTERN.match(value)
+            if match is not None:
+                # Join chunks
+                try:
+                    value = value[match.end():] + ''.join(
+                            raw["{0}{1}{2}".format(key, CHUNK_SEPARATOR, idx)]
+                            for idx in range(1, int(match.group(1))))
+
+                except KeyError as ex:
+                    _logger.error("Missing chunk %s of %s", ex, key)
+                    continue
+
+        elif CHUNK_SEPARATOR in key:
+            base_key, _, idx = key.rpartition(CHUNK_SEPARATOR)
+            if idx.isdigit() and is_string(raw.get(base_key)) \
+                    and _CHUNK_PATTERN.match(raw[base_key]) is not None:
+                # Chunk of another value
+                continue
+
+        result[intern_string(key)] = intern_value(decode_value(value))
+
+    return result
+
+# ------------------------------------------------------------------------------
+
+def _legacy_serialize(props):
+    """
+    Previous encoding of the mDNS discovery, kept for the benchmark
+    """
+    new_props = {}
+    for key, value in props.items():
+        if is_string(value):
+            new_props[key] = value
+
+        else:
+            try:
+                new_props[key] = json.dumps(value)
+
+            except (TypeError, ValueError):
+                new_props[key] = "pelix-type:{0}:{1}" \
+                                 .format(type(value).__name__, repr(value))
+
+    return new_props
+
+
+def _legacy_deserialize(props):
+    """
+    Previous decoding of the mDNS discovery, kept for the benchmark
+    """
+    new_props = {}
+    for key, value in props.items():
+        try:
+            new_props[key] = json.loads(value)
+
+        except ValueError:
+            if value.startswith("pelix-type:"):
+                value_type, value = value.split(":", 3)[2:]
+                new_props[key] = eval(value)
+
+            else:
+                new_props[key] = value
+
+    return new_props
+
+
+if __name__ == "__main__":
+    # Compares the encoding speed with the previous json/eval encoding
+    # Run with: python -m experiment.txt_codec
+    import timeit
+    import uuid
+
+    properties = {
+        "objectClass": "com.mycorp.examples.timeservice.ITimeService",
+        "endpoint.id": str(uuid.uuid4()),
+        "endpoint.framework.uuid": str(uuid.uuid4()),
+        "endpoint.service.id": 42,
+        "service.imported.configs": "ecf.jabsorb",
+        "service.intents": "passByValue exactlyOnce ordered",
+        "ecf.jabsorb.name": "service_42",
+        "ecf.jabsorb.accesses": "http://192.168.1.10:8080/JABSORB-RPC",
+        "ecf.endpoint.id.ns": "ecf.namespace.jabsorb",
+        "service.ranking": 0,
+        "pelix.access.port": 8080,
+        "weight": 1.5,
+        "tags": ("a", "b"),
+    }
+
+    legacy = _legacy_serialize(properties)
+    encoded = encode_properties(properties)
+    assert decode_properties(encoded) == properties
+
+    # Values from peers using the previous encoding (tuples become lists)
+    assert decode_properties(legacy)["tags"] == ["a", "b"]
+    assert decode_properties(legacy)["weight"] == 1.5
+
+    number = 20000
+    for name, function, args in (
+            ("legacy encode", _legacy_serialize, properties),
+            ("typed encode", encode_properties, properties),
+            ("legacy decode", _legacy_deserialize, legacy),
+            ("typed decode", decode_properties, encoded)):
+        duration = timeit.timeit(lambda: function(args), number=number)
+        print("{0:<15}: {1:.2f} us/call".format(name,
+                                                 duration * 1000000 / number))
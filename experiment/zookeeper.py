@@ -37,14 +37,30 @@ __docformat__ = "restructuredtext en"
 
 # ------------------------------------------------------------------------------
 
+# Local
+from experiment.interning import intern_properties
+
 # iPOPO decorators
 from pelix.ipopo.decorators import ComponentFactory, Requires, Provides, \
     Invalidate, Validate, Property, Instantiate
+import pelix.framework
 import pelix.remote
 import pelix.remote.beans as beans
 
 # Standard library
+import json
 import logging
+import multiprocessing
+import os
+import threading
+
+try:
+    # Python 3
+    import queue
+
+except ImportError:
+    # Python 2
+    import Queue as queue
 
 # ------------------------------------------------------------------------------
 
@@ -53,6 +69,9 @@ _logger = logging.getLogger(__name__)
 # KaZoo: ZooKeeper client in Python
 try:
     import kazoo.client as kazoo
+    from kazoo.exceptions import KazooException, ConnectionLoss, \
+        SessionExpiredError
+    from kazoo.protocol.states import EventType
     import javaobj
 
 except ImportError:
@@ -62,15 +81,132 @@ except ImportError:
 
 # ------------------------------------------------------------------------------
 
+ZOODISCOVERY_ROOT = "/zoodiscovery_root"
+""" Parent node of the ECF discovery nodes """
+
+TRANSACTION_MAX_OPS = 100
+""" Maximum number of operations in a ZooKeeper transaction """
+
+TRANSACTION_MAX_SIZE = 512 * 1024
+"""
+Maximum size of the nodes contents in a transaction (ZooKeeper requests are
+limited to 1 MB by default)
+"""
+
+POOL_MIN_BATCH = 16
+"""
+Minimum number of nodes to decode at once to use the process pool: smaller
+batches are decoded in the worker thread
+"""
+
+# ------------------------------------------------------------------------------
+
+def _from_java(value):
+    """
+    Converts a Java object and its fields into Python dictionaries and lists
+
+    :param value: A value read by javaobj
+    :return: The converted value
+    """
+    if isinstance(value, javaobj.JavaObject):
+        # FIXME: keeps all public fields
+        values = {}
+        for field in dir(value):
+            if field not in ('classdesc', 'annotations') \
+            and not field.startswith('_'):
+                values[field] = _from_java(getattr(value, field))
+
+        return values
+
+    elif isinstance(value, list):
+        return [_from_java(item) for item in value]
+
+    return value
+
+
+def _dump_properties(properties):
+    """
+    Converts the properties of an endpoint into the content of its node.
+    Values which can't be converted to JSON are ignored.
+
+    :param properties: Endpoint properties
+    :return: The node content (bytes)
+    """
+    try:
+        content = json.dumps(properties)
+
+    except (TypeError, ValueError):
+        # Remove invalid values
+        valid = {}
+        for key, value in properties.items():
+            try:
+                json.dumps(value)
+
+            except (TypeError, ValueError):
+                _logger.warning("Property %s can't be published: %s",
+                                key, value)
+
+            else:
+                valid[key] = value
+
+        content = json.dumps(valid)
+
+    return content.encode("UTF-8")
+
+
+def _load_properties(data):
+    """
+    Loads the properties stored in a discovery node. Called by the processes
+    of the decoding pool: the result only contains Python types.
+
+    :param data: Content of the node (Java serialized, or JSON for the nodes
+                 published by Pelix)
+    :return: The properties dictionary, or None
+    """
+    if data[:1] == b'{':
+        # Pelix node
+        try:
+            return json.loads(data.decode("UTF-8"))
+
+        except ValueError as ex:
+            _logger.error("Error loading JSON data: %s", ex)
+            return None
+
+    try:
+        content = javaobj.loads(data)
+
+    except Exception as ex:
+        _logger.exception("Error loading serialized data: %s", ex)
+        return None
+
+    return dict((key, _from_java(value)) for key, value in content.items())
+
+# ------------------------------------------------------------------------------
+
 @ComponentFactory("experiment-zookeeper-discovery-factory")
-# @Provides(pelix.remote.SERVICE_ENDPOINT_LISTENER, '_controller')
+@Provides(pelix.remote.SERVICE_ENDPOINT_LISTENER, '_controller')
 @Requires("_registry", pelix.remote.SERVICE_REGISTRY)
 @Property('_hosts', 'zookeeper.hosts', 'disco.ecf-project.org')
-# @Property("_listener_flag", pelix.remote.PROP_LISTEN_EXPORTED, True)
+@Property('_snapshot_file', 'zookeeper.snapshot.file', None)
+@Property('_publish', 'zookeeper.publish', False)
+@Property("_listener_flag", pelix.remote.PROP_LISTEN_EXPORTED, True)
 @Instantiate('test-zookeeper')
 class ZookeeperDiscovery(object):
     """
-    Discovery through ZooKeeper
+    Discovery through ZooKeeper.
+
+    The discovery nodes are read once per session, then only the nodes
+    notified by the children and data watches are read again.
+    All the reads and registry calls are made by a worker thread.
+
+    If the "zookeeper.snapshot.file" property is set, the known nodes are
+    stored in that snapshot file, loaded before connecting to ZooKeeper: its
+    endpoints are imported at once, then reconciled with the versions of the
+    nodes when the session is established.
+
+    If the "zookeeper.publish" property is set, exported endpoints are
+    published as ephemeral nodes, with JSON content. The changes made while
+    the worker thread is busy are written together, in transactions.
     """
     def __init__(self):
         """
@@ -85,11 +221,51 @@ class ZookeeperDiscovery(object):
         # Service controller
         self._controller = False
 
+        # Publish the exported endpoints
+        self._publish = False
+
         # Zookeeper hosts
         self._hosts = None
 
+        # Framework UID
+        self._fw_uid = None
+
+        # Exported endpoint UID -> node content
+        self.__exports = {}
+
+        # Exported endpoint UID -> node content, or None to delete the node,
+        # waiting to be written
+        self.__to_publish = {}
+        self.__publish_lock = threading.Lock()
+
+        # UIDs of the endpoints published in the current session
+        self.__published = set()
+
+        # Snapshot file (no snapshot if empty)
+        self._snapshot_file = None
+        self.__dirty = False
+
         # Zookeeper connection
         self.__zookeeper = None
+        self.__connected = False
+
+        # Watches are set for the current session
+        self.__watching = False
+
+        # Node name -> (node key, imported endpoint UID or None)
+        # The key of a node is its (czxid, version) tuple
+        self.__nodes = {}
+
+        # Node key -> decoded properties (or None)
+        self.__properties = {}
+
+        # Decoding processes, started on the first large batch
+        self.__pool = None
+        self.__pool_failed = False
+
+        # Worker thread and its tasks: (method, arguments) or None to stop
+        self.__tasks = queue.Queue()
+        self.__thread = None
 
 
     @Invalidate
@@ -100,8 +276,35 @@ class ZookeeperDiscovery(object):
         if self.__zookeeper is not None:
             _logger.debug("Stopping Zookeeper")
             self.__zookeeper.stop()
-
+            self.__zookeeper = None
+
+        # Stop the worker thread
+        if self.__thread is not None:
+            self.__tasks.put(None)
+            self.__thread.join(5)
+            self.__thread = None
+
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool.join()
+            self.__pool = None
+
+        self.__pool_failed = False
+
+        # Remove the imported endpoints
+        for _, uid in self.__nodes.values():
+            if uid is not None:
+                self._registry.remove(uid)
+
+        self.__nodes.clear()
+        self.__properties.clear()
+        self.__exports.clear()
+        self.__to_publish.clear()
+        self.__published.clear()
+        self.__watching = False
+        self.__connected = False
         self._controller = False
+        self._fw_uid = None
 
 
     @Validate
@@ -113,6 +316,23 @@ class ZookeeperDiscovery(object):
             _logger.error("Missing host property")
             return
 
+        # Get the framework UID
+        self._fw_uid = context.get_property(pelix.framework.FRAMEWORK_UID)
+
+        # Start the worker thread
+        self.__tasks = queue.Queue()
+        self.__thread = threading.Thread(target=self.__worker_loop,
+                                         name="Zookeeper-Discovery")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+        # Import the last known endpoints
+        self.__tasks.put((self.__load_snapshot, ()))
+
+        # Listen to the exported endpoints, even while disconnected, to keep
+        # track of them
+        self._controller = bool(self._publish)
+
         # Prepare the connection
         self.__zookeeper = kazoo.KazooClient(hosts=self._hosts)
 
@@ -125,73 +345,570 @@ class ZookeeperDiscovery(object):
         _logger.debug("Started.")
 
 
-    def __print_data(self, uid, data):
+    def __worker_loop(self):
+        """
+        Executes the queued tasks
+        """
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                # Stop order
+                if self.__dirty:
+                    self.__save_snapshot()
+                break
+
+            method, args = task
+            try:
+                method(*args)
+
+            except Exception as ex:
+                _logger.exception("Error synchronizing with ZooKeeper: %s", ex)
+
+            if self.__dirty and self.__tasks.empty():
+                # Store the changes once the pending tasks are done
+                self.__save_snapshot()
+
+
+    def __load_snapshot(self):
         """
+        Imports the endpoints of the nodes stored in the snapshot file
         """
-        # Load data
+        if not self._snapshot_file:
+            return
+
         try:
-            content = javaobj.loads(data)
+            with open(self._snapshot_file, 'r') as filep:
+                snapshot = json.load(filep)
 
-        except Exception as ex:
-            _logger.exception("Error loading serialized data: %s", ex)
+        except (IOError, OSError, ValueError) as ex:
+            _logger.debug("No ZooKeeper discovery snapshot loaded: %s", ex)
             return
 
-        # Prepare properties
-        props = {}
+        if snapshot.get('hosts') != self._hosts:
+            # Snapshot of another ZooKeeper
+            _logger.debug("Ignoring the snapshot of %s", snapshot.get('hosts'))
+            return
 
-        # Read base values
-        for key, value in content.items():
-            if isinstance(value, javaobj.JavaObject):
-                value = self._from_java(value)
+        try:
+            for name, node in snapshot['nodes'].items():
+                key = (node['czxid'], node['version'])
+                props = node['properties']
+                if props is not None:
+                    props = intern_properties(props)
 
-            props[key] = value
+                self.__properties[key] = props
+                self.__node_loaded(name, key)
 
-        from pprint import pformat
-        _logger.debug("Loaded UID %s:\n%s", uid, pformat(props))
+        except (KeyError, TypeError, AttributeError) as ex:
+            _logger.warning("Invalid ZooKeeper discovery snapshot: %s", ex)
 
-        # Convert to an endpoint
-        endpoint = beans.EndpointDescription(None, props)
-        _logger.debug("Result endpoint: %s", endpoint)
+        # Nothing new to store
+        self.__dirty = False
+        _logger.debug("%d nodes loaded from the snapshot", len(self.__nodes))
 
 
-    def _from_java(self, value):
+    def __save_snapshot(self):
         """
+        Writes the known nodes to the snapshot file
         """
-        # FIXME:
-        values = {}
-        for field in dir(value):
-            if field not in ('classdesc', 'annotations') \
-            and not field.startswith('_'):
-                values[field] = getattr(value, field)
+        self.__dirty = False
+        if not self._snapshot_file:
+            return
 
-        return values
+        nodes = {}
+        for name, (key, _) in self.__nodes.items():
+            props = self.__properties.get(key)
+            if props is not None and \
+                    props.get(pelix.remote.PROP_ENDPOINT_FRAMEWORK_UUID) \
+                    == self._fw_uid:
+                # Our exports are deleted with our session
+                continue
+
+            nodes[name] = {'czxid': key[0], 'version': key[1],
+                           'properties': props}
+
+        # Replace the file at once
+        tmp_file = self._snapshot_file + ".tmp"
+        try:
+            with open(tmp_file, 'w') as filep:
+                json.dump({'hosts': self._hosts, 'nodes': nodes}, filep)
+
+            try:
+                os.rename(tmp_file, self._snapshot_file)
 
+            except OSError:
+                # Windows: can't rename over an existing file
+                os.remove(self._snapshot_file)
+                os.rename(tmp_file, self._snapshot_file)
 
-    def load_content(self):
+        except (IOError, OSError, TypeError, ValueError) as ex:
+            _logger.warning("Error writing the ZooKeeper discovery snapshot: "
+                            "%s", ex)
+
+
+    def __synchronize(self, full):
         """
+        Reads the list of discovery nodes and sets the children watch
+
+        :param full: If True, all nodes are read, else only the new ones
         """
-        # Name of the discovery node
-        root = "/zoodiscovery_root"
+        zookeeper = self.__zookeeper
+        if zookeeper is None:
+            # Component invalidated
+            return
 
         try:
-            # Look at all of its children
-            _logger.debug("Getting children of %s", root)
-            uids = self.__zookeeper.get_children(root)
-            _logger.debug("Look at %s", uids)
-            for uid in uids:
-                # Get node data
-                _logger.debug("Reading %s...", uid)
-                data = self.__zookeeper.get("{0}/{1}".format(root, uid))[0]
-
-                # Print it
-                self.__print_data(uid, data)
+            children = set(zookeeper.get_children(ZOODISCOVERY_ROOT,
+                                                  watch=self.__children_watch))
 
         except kazoo.NoNodeError:
-            _logger.debug("Discovery nodes not found")
+            _logger.debug("Discovery nodes not found: waiting for them")
+
+            # Forget the known nodes (loaded from the snapshot)
+            for name in list(self.__nodes):
+                self.__remove_node(name)
+
+            if zookeeper.exists(ZOODISCOVERY_ROOT, watch=self.__root_watch):
+                # Created meanwhile
+                self.__tasks.put((self.__synchronize, (full,)))
+
+            return
+
+        # Forget removed nodes
+        for name in set(self.__nodes) - children:
+            self.__remove_node(name)
+
+        if not full:
+            # Only read new nodes
+            children.difference_update(self.__nodes)
+
+        self.__read_nodes(children)
+
+
+    def __read_nodes(self, names):
+        """
+        Reads the given discovery nodes, in parallel, and sets their data watch
+
+        :param names: Names of the nodes to read
+        """
+        zookeeper = self.__zookeeper
+        if zookeeper is None:
+            # Component invalidated
+            return
+
+        # Send all requests at once
+        requests = [(name, zookeeper.get_async(
+                            "{0}/{1}".format(ZOODISCOVERY_ROOT, name),
+                            watch=self.__node_watch))
+                    for name in names]
+
+        loaded = []
+        to_decode = []
+        for name, request in requests:
+            try:
+                data, stat = request.get()
+
+            except kazoo.NoNodeError:
+                # Deleted meanwhile: the children watch will be notified
+                continue
+
+            key = (stat.czxid, stat.version)
+            loaded.append((name, key))
+            if key not in self.__properties:
+                # Never decoded
+                to_decode.append((key, data))
+
+        self.__decode(to_decode)
+
+        for name, key in loaded:
+            self.__node_loaded(name, key)
+
+
+    def __decode(self, contents):
+        """
+        Decodes the given node contents, in the process pool if there are
+        enough of them, and stores the results in the properties cache
+
+        :param contents: A list of (node key, data) tuples
+        """
+        if not contents:
+            return
+
+        datas = [data for _, data in contents]
+        pool = None
+        if len(datas) >= POOL_MIN_BATCH:
+            pool = self.__get_pool()
+
+        if pool is not None:
+            decoded = pool.map(_load_properties, datas)
+
+        else:
+            decoded = [_load_properties(data) for data in datas]
+
+        for (key, _), props in zip(contents, decoded):
+            if props is not None:
+                # Share the strings of all endpoints
+                props = intern_properties(props)
+
+            self.__properties[key] = props
+
+
+    def __get_pool(self):
+        """
+        Returns the decoding processes pool, starting it on first call.
+
+        The processes are started with the "forkserver" or "spawn" method, as
+        forking this process, which runs the ZooKeeper threads, is unsafe.
+
+        :return: The process pool, or None if it can't be used
+        """
+        if self.__pool is not None or self.__pool_failed:
+            return self.__pool
+
+        try:
+            methods = multiprocessing.get_all_start_methods()
+
+        except AttributeError:
+            # Python < 3.4: processes can only be forked
+            _logger.debug("No safe start method for the decoding processes")
+            self.__pool_failed = True
+            return None
+
+        method = "forkserver" if "forkserver" in methods else "spawn"
+        try:
+            self.__pool = multiprocessing.get_context(method).Pool()
+
+        except (OSError, ImportError, ValueError, RuntimeError) as ex:
+            _logger.warning("Can't start the decoding processes: %s", ex)
+            self.__pool_failed = True
+
+        return self.__pool
+
+
+    def __node_loaded(self, name, key):
+        """
+        Imports, updates or ignores the endpoint described by a node
+
+        :param name: Name of the node
+        :param key: The (czxid, version) key of the node content
+        """
+        try:
+            old_key, uid = self.__nodes[name]
+            if old_key == key:
+                # Unchanged node
+                return
+
+        except KeyError:
+            # New node
+            old_key = None
+            uid = None
+
+        endpoint = None
+        props = self.__properties.get(key)
+        if props is not None and \
+                props.get(pelix.remote.PROP_ENDPOINT_FRAMEWORK_UUID) \
+                == self._fw_uid:
+            # One of our exports
+            props = None
+
+        if props is not None:
+            try:
+                # Convert to an endpoint
+                endpoint = beans.to_import(beans.EndpointDescription(None,
+                                                                     props))
+
+            except ValueError as ex:
+                _logger.warning("Invalid endpoint description in %s: %s",
+                                name, ex)
+
+        if endpoint is not None and endpoint.uid == uid:
+            # Same endpoint, new properties
+            self._registry.update(uid, endpoint.properties)
+
+        else:
+            if uid is not None:
+                # The node describes another endpoint
+                self._registry.remove(uid)
+                uid = None
+
+            if endpoint is not None and self._registry.add(endpoint):
+                uid = endpoint.uid
+
+        if old_key is not None:
+            # Forget the previous content
+            self.__properties.pop(old_key, None)
+
+        self.__nodes[name] = (key, uid)
+        self.__dirty = True
+
+
+    def __remove_node(self, name):
+        """
+        Removes the endpoint described by a deleted node
+
+        :param name: Name of the node
+        """
+        key, uid = self.__nodes.pop(name)
+        self.__properties.pop(key, None)
+        self.__dirty = True
+        if uid is not None:
+            self._registry.remove(uid)
+
+
+    def endpoints_added(self, endpoints):
+        """
+        Multiple endpoints have been exported
+
+        :param endpoints: A list of ExportEndpoint beans
+        """
+        contents = {}
+        for endpoint in endpoints:
+            properties = beans.from_export(endpoint).get_properties()
+            contents[endpoint.uid] = _dump_properties(properties)
+
+        self.__queue_publication(contents)
+
+
+    def endpoint_updated(self, endpoint, old_properties):
+        """
+        An exported endpoint has been updated
+
+        :param endpoint: The updated ExportEndpoint bean
+        :param old_properties: The previous properties of the endpoint
+        """
+        properties = beans.from_export(endpoint).get_properties()
+        self.__queue_publication({endpoint.uid:
+                                  _dump_properties(properties)})
+
+
+    def endpoint_removed(self, endpoint):
+        """
+        An endpoint is not exported anymore
+
+        :param endpoint: The removed ExportEndpoint bean
+        """
+        self.__queue_publication({endpoint.uid: None})
+
+
+    def __queue_publication(self, contents):
+        """
+        Queues the writing of the nodes of the given endpoints. The writing
+        task is queued only if there was nothing waiting to be written.
+
+        :param contents: Endpoint UID -> node content (None to delete)
+        """
+        with self.__publish_lock:
+            # The writing task is queued if something is waiting
+            queued = bool(self.__to_publish)
+            changed = False
+            for uid, content in contents.items():
+                if self.__exports.get(uid) == content \
+                        and uid not in self.__to_publish:
+                    # Already published
+                    continue
+
+                if content is None:
+                    self.__exports.pop(uid, None)
+
+                else:
+                    self.__exports[uid] = content
+
+                self.__to_publish[uid] = content
+                changed = True
+
+            if not changed or queued:
+                # Nothing new, or the writing task is already queued
+                return
+
+        self.__tasks.put((self.__publish, ()))
+
+
+    def __republish(self):
+        """
+        Writes the nodes of all exported endpoints again, as ephemeral nodes
+        are deleted with their session
+        """
+        self.__published.clear()
+        with self.__publish_lock:
+            self.__to_publish.update(self.__exports)
+
+        self.__publish()
+
+
+    def __publish(self):
+        """
+        Writes the nodes of the exported endpoints, in transactions
+        """
+        with self.__publish_lock:
+            to_publish = self.__to_publish.copy()
+            self.__to_publish.clear()
+
+        zookeeper = self.__zookeeper
+        if zookeeper is None or not to_publish:
+            # Component invalidated or nothing to do
             return
 
+        elif not self.__connected:
+            # Not connected: keep the operations for the reconnection
+            self.__requeue(to_publish)
+            return
+
+        # Prepare the operations: (method name, endpoint UID, content)
+        operations = []
+        for uid, content in to_publish.items():
+            if content is None:
+                if uid in self.__published:
+                    operations.append(('delete', uid, None))
+
+            elif uid in self.__published:
+                operations.append(('set_data', uid, content))
+
+            else:
+                operations.append(('create', uid, content))
+
+        # Group them in transactions
+        batches = []
+        batch = []
+        batch_size = 0
+        for operation in operations:
+            size = len(operation[2] or '')
+            if batch and (len(batch) >= TRANSACTION_MAX_OPS
+                          or batch_size + size > TRANSACTION_MAX_SIZE):
+                batches.append(batch)
+                batch = []
+                batch_size = 0
+
+            batch.append(operation)
+            batch_size += size
+
+        if batch:
+            batches.append(batch)
+
+        try:
+            zookeeper.ensure_path(ZOODISCOVERY_ROOT)
+            while batches:
+                self.__commit(batches[0])
+                del batches[0]
+
+        except KazooException as ex:
+            # Connection lost or session expired: write the operations which
+            # haven't been committed on reconnection
+            _logger.warning("Error publishing endpoints, will retry: %s", ex)
+            self.__requeue(dict((uid, content) for batch in batches
+                                for _, uid, content in batch))
+
+
+    def __requeue(self, to_publish):
+        """
+        Puts back operations which couldn't be written, unless newer ones
+        have been queued meanwhile
+
+        :param to_publish: Endpoint UID -> node content (None to delete)
+        """
+        with self.__publish_lock:
+            for uid, content in to_publish.items():
+                self.__to_publish.setdefault(uid, content)
+
+
+    def __commit(self, operations):
+        """
+        Executes the given operations in a single transaction. If it fails,
+        the operations are executed one by one.
+
+        :param operations: A list of (method name, endpoint UID, content)
+        """
+        transaction = self.__zookeeper.transaction()
+        for method, uid, content in operations:
+            path = "{0}/{1}".format(ZOODISCOVERY_ROOT, uid)
+            if method == 'create':
+                transaction.create(path, content, ephemeral=True)
+
+            elif method == 'set_data':
+                transaction.set_data(path, content)
+
+            else:
+                transaction.delete(path)
+
+        # Connection errors are propagated, for the operations to be retried
+        results = transaction.commit()
+        if not any(isinstance(result, Exception) for result in results):
+            # Success
+            for method, uid, _ in operations:
+                if method == 'delete':
+                    self.__published.discard(uid)
+
+                else:
+                    self.__published.add(uid)
+
+            return
+
+        # The whole transaction has been rolled back
+        _logger.debug("Transaction failed, executing operations one by one")
+        for method, uid, content in operations:
+            self.__execute(method, uid, content)
+
+
+    def __execute(self, method, uid, content):
+        """
+        Executes a single node operation, handling the state of the node
+
+        :param method: Name of the operation
+        :param uid: Endpoint UID
+        :param content: New content of the node
+        """
+        zookeeper = self.__zookeeper
+        path = "{0}/{1}".format(ZOODISCOVERY_ROOT, uid)
+        try:
+            if method == 'delete':
+                try:
+                    zookeeper.delete(path)
+
+                except kazoo.NoNodeError:
+                    # Already deleted
+                    pass
+
+                self.__published.discard(uid)
+                return
+
+            try:
+                zookeeper.create(path, content, ephemeral=True)
+
+            except kazoo.NodeExistsError:
+                # Left by a previous operation of this session
+                zookeeper.set(path, content)
+
+            self.__published.add(uid)
+
+        except (ConnectionLoss, SessionExpiredError):
+            # Retried on reconnection
+            raise
+
         except Exception as ex:
-            _logger.exception("Bad: %s", ex)
+            _logger.error("Error publishing endpoint %s: %s", uid, ex)
+
+
+    def __children_watch(self, event):
+        """
+        The list of discovery nodes changed (ZooKeeper callback thread)
+        """
+        self.__tasks.put((self.__synchronize, (False,)))
+
+
+    def __root_watch(self, event):
+        """
+        The discovery root node has been created (ZooKeeper callback thread)
+        """
+        if event.type == EventType.CREATED:
+            self.__tasks.put((self.__synchronize, (True,)))
+
+
+    def __node_watch(self, event):
+        """
+        The content of a discovery node changed (ZooKeeper callback thread)
+        """
+        if event.type == EventType.CHANGED:
+            name = event.path.rsplit('/', 1)[-1]
+            self.__tasks.put((self.__read_nodes, ([name],)))
 
 
     def _zookeeper_event(self, state):
@@ -202,22 +919,29 @@ class ZookeeperDiscovery(object):
 
         if state == kazoo.KazooState.LOST:
             # Register somewhere that the session was lost
-            self._controller = False
+            self.__connected = False
             _logger.debug("Lost !")
 
+            # Watches are lost with the session
+            self.__watching = False
+
         elif state == kazoo.KazooState.SUSPENDED:
-            # Handle being disconnected from Zookeeper
-            self._controller = False
+            # Handle being disconnected from Zookeeper: watches are kept
+            self.__connected = False
             _logger.debug("Suspended !")
 
         else:
             # Handle being connected/reconnected to Zookeeper
-            self._controller = True
+            self.__connected = True
             _logger.debug("Connected !")
 
-            _logger.debug("Loading...")
-            import threading
-            thread = threading.Thread(target=self.load_content)
-            thread.daemon = True
-            thread.start()
+            if not self.__watching:
+                # New session: read all nodes, set the watches and publish
+                # our endpoints
+                self.__watching = True
+                self.__tasks.put((self.__synchronize, (True,)))
+                self.__tasks.put((self.__republish, ()))
 
+            else:
+                # Same session: write the changes made while disconnected
+                self.__tasks.put((self.__publish, ()))